@@ -0,0 +1,85 @@
+'''
+Micro-benchmark of the token verification in authorize.py.
+
+Compares tokens verified per second when the certificate PEM is handed to the jwt decoder
+(parsed again for every token and every candidate key, as before) against the key objects
+parsed once per jwks fetch. A local RS256 key set is generated, no network is used.
+
+    python benchmark_authorize.py [n_tokens]
+'''
+import base64, contextlib, datetime, io, os, sys, time
+
+os.environ.setdefault('AUTH0_APPLICATION_URL', 'https://benchmark.auth0.com/')
+
+from cryptography import x509
+from cryptography.hazmat.primitives import hashes, serialization
+from cryptography.hazmat.primitives.asymmetric import rsa
+from cryptography.x509.oid import NameOID
+import authorize
+
+_N_KEYS = 2
+_USER = 'benchmark'
+
+
+def _generate_key(kid):
+    private_key = rsa.generate_private_key(public_exponent=65537, key_size=2048)
+    name = x509.Name([x509.NameAttribute(NameOID.COMMON_NAME, kid)])
+    now = datetime.datetime.now(tz=datetime.timezone.utc)
+    cert = x509.CertificateBuilder().subject_name(name).issuer_name(name) \
+        .public_key(private_key.public_key()).serial_number(x509.random_serial_number()) \
+        .not_valid_before(now).not_valid_after(now + datetime.timedelta(days=1)) \
+        .sign(private_key, hashes.SHA256())
+    x5c = base64.b64encode(cert.public_bytes(serialization.Encoding.DER)).decode('ascii')
+    private_pem = private_key.private_bytes(
+        serialization.Encoding.PEM, serialization.PrivateFormat.PKCS8, serialization.NoEncryption())
+    return private_pem, x5c
+
+
+def _encode_token(private_pem, kid):
+    base_url = authorize._APPLICATION_BASE_URL
+    payload = {
+        'iss': base_url,
+        'sub': 'auth0|' + _USER,
+        'aud': base_url + authorize._AUDIENCE_URL_PATH,
+        'exp': int(time.time()) + 3600,
+    }
+    return authorize._JWT.encode({'alg': 'RS256', 'kid': kid}, payload, private_pem).decode('ascii')
+
+
+def _run(label, n, verify):
+    start = time.perf_counter()
+    # the failed trial decodes print the reason, which is not what is measured here.
+    with contextlib.redirect_stdout(io.StringIO()):
+        for _ in range(n):
+            if not verify():
+                raise RuntimeError('{l}: the token did not verify'.format(l=label))
+    elapsed = time.perf_counter() - start
+    print('{l:<32} {r:>10.1f} tokens/s'.format(l=label, r=n / elapsed))
+    return n / elapsed
+
+
+def main():
+    n = int(sys.argv[1]) if len(sys.argv) > 1 else 500
+    keys = [_generate_key('kid-{i}'.format(i=i)) for i in range(_N_KEYS)]
+    # the signing key is the last one so the trial decoding visits every key, as it did before.
+    event = {'headers': {'Authorization': 'Bearer ' + _encode_token(keys[-1][0], 'kid-{i}'.format(i=_N_KEYS - 1))}}
+    pems = [(authorize._KEY_PREFIX + x5c + authorize._KEY_POSTFIX) for _, x5c in keys]
+    parsed_key = authorize._import_key(keys[-1][1])
+
+    def verify_before():
+        for pem in pems:
+            # the PEM is parsed and the RSA key rebuilt on every decode.
+            if authorize._validate(event, pem.encode('ascii'), _USER):
+                return True
+        return False
+
+    def verify_after():
+        return authorize._validate(event, parsed_key, _USER)
+
+    before = _run('pem per token, trial decoding', n, verify_before)
+    after = _run('parsed key, kid lookup', n, verify_after)
+    print('speedup: {s:.1f}x'.format(s=after / before))
+
+
+if __name__ == '__main__':
+    main()
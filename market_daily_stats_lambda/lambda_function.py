@@ -1,4 +1,4 @@
-import datetime, decimal
+import datetime, decimal, hashlib, os
 import json
 import boto3
 from boto3.dynamodb.conditions import Key, Attr
@@ -11,15 +11,24 @@ _DATASET_ID_BINANCE = 'market_data_binance'
 _RESOURCE_DYNAMODB = 'dynamodb'
 _TABLE_NAME = 'market_daily_stat'
 _EVENT_KEY_QUERY_STRING_PARAMETER = 'queryStringParameters'
+_EVENT_KEY_HEADERS = 'headers'
+_HEADER_KEY_ETAG = 'ETag'
+_HEADER_KEY_IF_NONE_MATCH = 'If-None-Match'
 _PARAM_KEY_DATE_STR = 'date_str'
 _PARAM_KEY_MARKET = 'market'
 _PARAM_KEY_SYMBOL = 'symbol'
+_PARAM_KEY_FIELDS = 'fields'
 _DATABASE_KEY_SYMBOL = 'symbol'
 _DATABASE_KEY_DATE_STR = 'date_str'
 _DATABASE_KEY_MARKET = 'market'
 _RESPONSE_KEY_DATE = 'date'
 _DATETIME_FORMAT = '%Y-%m-%dT%H:%M:%S%z'
 
+# the attributes read off the table (comma separated), every attribute is read if it is not set.
+_DATABASE_ATTRIBUTES = [a for a in os.getenv('MARKET_DAILY_STATS_ATTRIBUTES', '').split(',') if a]
+# the rows are filtered on market.
+_REQUIRED_DATABASE_ATTRIBUTES = [_DATABASE_KEY_MARKET]
+
 
 class DecimalEncoder(json.JSONEncoder):
     def default(self, obj):
@@ -43,25 +52,72 @@ def _get_today_date_str():
     return _get_now_et().strftime('%Y-%m-%d')
 
 
-def _get_items(date_str, symbol, market):
+def _get_attributes(fields):
+    '''
+    Returns the attributes to read for the response `fields`, None to read every attribute.
+    '''
+    attributes = list(_DATABASE_ATTRIBUTES)
+    if fields:
+        attributes = [f for f in fields if not attributes or f in attributes]
+        attributes += [a for a in _REQUIRED_DATABASE_ATTRIBUTES if a not in attributes]
+    return attributes or None
+
+
+def _get_projection(attributes):
+    '''
+    Returns the ProjectionExpression and its ExpressionAttributeNames, with placeholders for every
+    attribute as some of them may be reserved words.
+    '''
+    names = {'#p{i}'.format(i=i): a for i, a in enumerate(attributes)}
+    return ','.join(names.keys()), names
+
+
+def _get_items(date_str, symbol, market, attributes=None):
     dynamodb = boto3.resource(_RESOURCE_DYNAMODB)
     table = dynamodb.Table(_TABLE_NAME)
 
-    response = table.query(
-        KeyConditionExpression=Key(_DATABASE_KEY_DATE_STR).eq(date_str) & Key(_DATABASE_KEY_SYMBOL).eq(symbol),
-        FilterExpression=Attr(_DATABASE_KEY_MARKET).eq(market)
-    )
+    query_kwargs = {
+        'KeyConditionExpression': Key(_DATABASE_KEY_DATE_STR).eq(date_str) & Key(_DATABASE_KEY_SYMBOL).eq(symbol),
+        'FilterExpression': Attr(_DATABASE_KEY_MARKET).eq(market),
+    }
+    if attributes:
+        query_kwargs['ProjectionExpression'], query_kwargs['ExpressionAttributeNames'] = _get_projection(attributes)
+    response = table.query(**query_kwargs)
 
     items = response['Items']
     items = [i for i in items if i[_DATABASE_KEY_MARKET] == market]
     return items
 
 
+def _get_header(event, name):
+    headers = event.get(_EVENT_KEY_HEADERS) or {}
+    for k, v in headers.items():
+        if k.lower() == name.lower():
+            return v
+    return None
+
+
+def _with_etag(event, response):
+    '''
+    Sets the ETag of the response from a hash of its body, and answers 304 without the body
+    when the If-None-Match of the request already has it.
+    '''
+    etag = '"{h}"'.format(h=hashlib.sha1(response['body'].encode('utf-8')).hexdigest())
+    response['headers'][_HEADER_KEY_ETAG] = etag
+    if_none_match = _get_header(event, _HEADER_KEY_IF_NONE_MATCH)
+    if if_none_match:
+        etags = [t.strip().replace('W/', '', 1) for t in if_none_match.split(',')]
+        if etag in etags or '*' in etags:
+            return {'statusCode': 304, 'headers': response['headers']}
+    return response
+
+
 def lambda_handler(event, context):
     query_string_parameters = event[_EVENT_KEY_QUERY_STRING_PARAMETER]
     print("query_string_parameters:", query_string_parameters)
     market = 'stock'
     symbol = None
+    fields = None
     date_strs = [_get_today_date_str()]
     prev_date = _get_now_et() - datetime.timedelta(days=1)
     while market == 'stock' and prev_date.weekday() >= 5:
@@ -78,22 +134,29 @@ def lambda_handler(event, context):
         if _PARAM_KEY_DATE_STR in query_string_parameters:
             date_strs = query_string_parameters[_PARAM_KEY_DATE_STR].split(',')
 
+        if _PARAM_KEY_FIELDS in query_string_parameters:
+            fields = [f for f in query_string_parameters[_PARAM_KEY_FIELDS].split(',') if f]
+
     print("symbol: {s}, market: {m}, date_str: {d}".format(s=symbol, m=market, d=','.join(date_strs)))
 
+    attributes = _get_attributes(fields)
     items = []
     for date_str in date_strs:
         print('date_str:', date_str)
-        items += _get_items(date_str, symbol, market)
+        items += _get_items(date_str, symbol, market, attributes)
 
     result = list(map(lambda blob: dict_to_response(blob), items))
     result = result[:30]
+    if fields:
+        result = [{k: v for k, v in entry.items() if k in fields} for entry in result]
 
-    return {
+    return _with_etag(event, {
         'statusCode': 200,
         'headers': {
             'Access-Control-Allow-Headers': 'Content-Type',
             'Access-Control-Allow-Origin': '*',
-            'Access-Control-Allow-Methods': 'OPTIONS,POST,GET'
+            'Access-Control-Allow-Methods': 'OPTIONS,POST,GET',
+            'Access-Control-Expose-Headers': _HEADER_KEY_ETAG
         },
         'body': json.dumps(result, cls=DecimalEncoder)
-    }
+    })
@@ -0,0 +1,106 @@
+'''
+Creates a global secondary index of the financial_signal table and backfills its key attribute on the existing rows.
+
+The writers of financial_signal have to set the same attribute on new rows for the index to stay complete.
+
+    python backfill_index.py market_date_et-index --create-index
+    python backfill_index.py market_date_et-index --segments 8
+'''
+import argparse, concurrent.futures
+import boto3
+from boto3.dynamodb.conditions import Attr
+
+_RESOURCE_DYNAMODB = 'dynamodb'
+_TABLE_NAME = 'financial_signal'
+_DATABASE_KEY_DATE_ET = 'date_et'
+_DATABASE_KEY_TIMESTAMP = 'timestamp'
+_DATABASE_KEY_MARKET = 'market'
+_DATABASE_KEY_SYMBOL = 'symbol'
+
+# index name: (partition key attribute, the attributes it is derived from, how it is derived)
+_INDEXES = {
+    'market_date_et-index': ('market_date_et', [_DATABASE_KEY_MARKET, _DATABASE_KEY_DATE_ET],
+                             lambda item: '{m}#{d}'.format(m=item[_DATABASE_KEY_MARKET], d=item[_DATABASE_KEY_DATE_ET])),
+    'market_symbol-index': ('market_symbol', [_DATABASE_KEY_MARKET, _DATABASE_KEY_SYMBOL],
+                            lambda item: '{m}#{s}'.format(m=item[_DATABASE_KEY_MARKET], s=item[_DATABASE_KEY_SYMBOL])),
+}
+
+
+def create_index(index_name, read_capacity=None, write_capacity=None):
+    key_attribute = _INDEXES[index_name][0]
+    index = {
+        'IndexName': index_name,
+        'KeySchema': [
+            {'AttributeName': key_attribute, 'KeyType': 'HASH'},
+            {'AttributeName': _DATABASE_KEY_TIMESTAMP, 'KeyType': 'RANGE'},
+        ],
+        'Projection': {'ProjectionType': 'ALL'},
+    }
+    if read_capacity and write_capacity:
+        index['ProvisionedThroughput'] = {'ReadCapacityUnits': read_capacity, 'WriteCapacityUnits': write_capacity}
+
+    client = boto3.client(_RESOURCE_DYNAMODB)
+    response = client.update_table(
+        TableName=_TABLE_NAME,
+        AttributeDefinitions=[
+            {'AttributeName': key_attribute, 'AttributeType': 'S'},
+            {'AttributeName': _DATABASE_KEY_TIMESTAMP, 'AttributeType': 'N'},
+        ],
+        GlobalSecondaryIndexUpdates=[{'Create': index}]
+    )
+    print('creating the index {i}:'.format(i=index_name), response['TableDescription'].get('TableStatus'))
+
+
+def _backfill_segment(index_name, segment, total_segments):
+    key_attribute, source_attributes, derive = _INDEXES[index_name]
+    table = boto3.session.Session().resource(_RESOURCE_DYNAMODB).Table(_TABLE_NAME)
+    attributes = [_DATABASE_KEY_DATE_ET, _DATABASE_KEY_TIMESTAMP] + [a for a in source_attributes if a != _DATABASE_KEY_DATE_ET]
+    scan_kwargs = {
+        'Segment': segment,
+        'TotalSegments': total_segments,
+        'FilterExpression': Attr(key_attribute).not_exists(),
+        # timestamp is a reserved word, every attribute goes through a placeholder.
+        'ProjectionExpression': ','.join('#a{i}'.format(i=i) for i in range(len(attributes))),
+        'ExpressionAttributeNames': {'#a{i}'.format(i=i): a for i, a in enumerate(attributes)},
+    }
+
+    updated = 0
+    while True:
+        response = table.scan(**scan_kwargs)
+        for item in response['Items']:
+            if any(a not in item for a in source_attributes):
+                continue
+            table.update_item(
+                Key={_DATABASE_KEY_DATE_ET: item[_DATABASE_KEY_DATE_ET], _DATABASE_KEY_TIMESTAMP: item[_DATABASE_KEY_TIMESTAMP]},
+                UpdateExpression='SET #k = :v',
+                ExpressionAttributeNames={'#k': key_attribute},
+                ExpressionAttributeValues={':v': derive(item)},
+            )
+            updated += 1
+        if 'LastEvaluatedKey' not in response:
+            break
+        scan_kwargs['ExclusiveStartKey'] = response['LastEvaluatedKey']
+    print('segment {s}/{t}: updated {n} items'.format(s=segment, t=total_segments, n=updated))
+    return updated
+
+
+def backfill(index_name, total_segments):
+    with concurrent.futures.ThreadPoolExecutor(max_workers=total_segments) as executor:
+        futures = [executor.submit(_backfill_segment, index_name, segment, total_segments) for segment in range(total_segments)]
+        updated = sum(f.result() for f in futures)
+    print('updated {n} items for {i}'.format(n=updated, i=index_name))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('index_name', choices=sorted(_INDEXES.keys()))
+    parser.add_argument('--create-index', action='store_true', help='create the index instead of backfilling it.')
+    parser.add_argument('--read-capacity', type=int, help='only for a table with provisioned capacity.')
+    parser.add_argument('--write-capacity', type=int, help='only for a table with provisioned capacity.')
+    parser.add_argument('--segments', type=int, default=4, help='number of parallel scan segments.')
+    args = parser.parse_args()
+
+    if args.create_index:
+        create_index(args.index_name, args.read_capacity, args.write_capacity)
+    else:
+        backfill(args.index_name, args.segments)
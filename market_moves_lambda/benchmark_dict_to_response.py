@@ -0,0 +1,72 @@
+'''
+Benchmark of the row conversion of market_moves.
+
+Compares rows/sec of the per-row conversion (utcfromtimestamp, astimezone and strftime for
+every row, as dict_to_response did before) against dicts_to_response at 1k, 10k and 100k rows,
+and checks that both produce the same rows.
+
+    python benchmark_dict_to_response.py
+'''
+import datetime, decimal, random, time
+import pytz
+import lambda_function
+
+_ROW_COUNTS = [1000, 10000, 100000]
+
+
+def _dict_to_response_per_row(blob):
+    ret = {}
+    for k, v in blob.items():
+        key = k
+        val = v
+        if k == lambda_function._DATABASE_KEY_MIN_DROP or k == lambda_function._DATABASE_KEY_MAX_JUMP:
+            val = float(v)
+
+        if k == lambda_function._DATABASE_KEY_DATE_ET:
+            key = lambda_function._RESPONSE_KEY_DATE
+        ret[key] = val
+
+        if k == lambda_function._DATABASE_KEY_TIMESTAMP:
+            key = lambda_function._RESPONSE_KEY_DATETIME
+            utc_dt = datetime.datetime.utcfromtimestamp(int(v))
+            aware_utc_dt = utc_dt.replace(tzinfo=pytz.utc)
+            dt = aware_utc_dt.astimezone(lambda_function._TIMEZONE_EASTERN)
+            ret[key] = dt.strftime('%Y-%m-%dT%H:%M:%S%z')
+    return ret
+
+
+def _generate_rows(n):
+    random.seed(0)
+    now = int(time.time())
+    # a week of rows, newest first, as the queries return them.
+    return [{
+        'date_et': '2021-06-01',
+        'timestamp': decimal.Decimal(now - i * (7 * 24 * 3600 // n)),
+        'market': 'binance',
+        'symbol': 'SYM{i}USDT'.format(i=i % 300),
+        'min_drop': decimal.Decimal(str(round(-random.random() * 0.2, 6))),
+        'max_jump': decimal.Decimal(str(round(random.random() * 0.2, 6))),
+        'threshold': '0.1',
+        'window_size_minutes': decimal.Decimal(20),
+    } for i in range(n)]
+
+
+def _rows_per_second(f, rows):
+    start = time.perf_counter()
+    f(rows)
+    return len(rows) / (time.perf_counter() - start)
+
+
+def main():
+    for n in _ROW_COUNTS:
+        rows = _generate_rows(n)
+        if [_dict_to_response_per_row(row) for row in rows] != lambda_function.dicts_to_response(rows):
+            raise RuntimeError('the conversions differ for {n} rows'.format(n=n))
+        before = _rows_per_second(lambda rs: [_dict_to_response_per_row(row) for row in rs], rows)
+        after = _rows_per_second(lambda_function.dicts_to_response, rows)
+        print('{n:>7} rows: per row {b:>10.0f} rows/s, batched {a:>10.0f} rows/s, {x:.1f}x'.format(
+            n=n, b=before, a=after, x=after / before))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,93 @@
+'''
+Benchmark of the ProjectionExpression used by _query_page.
+
+A local stand-in for DynamoDB builds Query responses in the DynamoDB JSON wire format from
+synthetic financial_signal rows, with and without a projection, and measures the bytes read and
+the time boto3 spends deserializing them (json parsing plus TypeDeserializer) per 1,000 items.
+
+The synthetic rows carry extra attributes besides the ones the endpoint reads, standing in for
+what the writers of financial_signal store and the endpoint does not return.
+
+    python benchmark_projection.py [n_items]
+'''
+import decimal, json, random, sys, time
+from boto3.dynamodb.types import TypeDeserializer, TypeSerializer
+import lambda_function
+
+_REPEAT = 5
+
+
+def _generate_items(n):
+    random.seed(0)
+    now = int(time.time())
+    items = []
+    for i in range(n):
+        timestamp = now - i * 7
+        items.append({
+            'date_et': '2021-06-01',
+            'timestamp': timestamp,
+            'market': 'binance',
+            'symbol': 'SYM{i}USDT'.format(i=i % 300),
+            'min_drop': decimal.Decimal(str(round(-random.random() * 0.2, 6))),
+            'max_jump': decimal.Decimal(str(round(random.random() * 0.2, 6))),
+            'threshold': '0.1',
+            'window_size_minutes': 20,
+            # attributes the endpoint does not need.
+            'price_at_min_drop': decimal.Decimal(str(round(random.random() * 100, 4))),
+            'price_at_max_jump': decimal.Decimal(str(round(random.random() * 100, 4))),
+            'epoch_at_min_drop': timestamp - 300,
+            'epoch_at_max_jump': timestamp - 120,
+            'current_price': decimal.Decimal(str(round(random.random() * 100, 4))),
+            'prices': [decimal.Decimal(str(round(random.random() * 100, 4))) for _ in range(20)],
+            'source': 'market_realtime_move_report_kinesis',
+        })
+    return items
+
+
+def _query_response(items, attributes=None):
+    '''
+    Returns the Query response body the stand-in would send, in the DynamoDB wire format.
+    '''
+    serializer = TypeSerializer()
+    wire_items = []
+    for item in items:
+        if attributes:
+            item = {k: v for k, v in item.items() if k in attributes}
+        wire_items.append({k: serializer.serialize(v) for k, v in item.items()})
+    return json.dumps({'Items': wire_items, 'Count': len(wire_items), 'ScannedCount': len(wire_items)}).encode('utf-8')
+
+
+def _deserialize(body):
+    deserializer = TypeDeserializer()
+    js = json.loads(body)
+    return [{k: deserializer.deserialize(v) for k, v in item.items()} for item in js['Items']]
+
+
+def _run(label, items, attributes):
+    body = _query_response(items, attributes)
+    elapsed = min(_timed(_deserialize, body) for _ in range(_REPEAT))
+    per_1000 = 1000 / len(items)
+    print('{l:<28} {b:>10.1f} KB  {t:>8.2f} ms  per 1,000 items'.format(
+        l=label, b=len(body) * per_1000 / 1024, t=elapsed * per_1000 * 1000))
+    return len(body), elapsed
+
+
+def _timed(f, *args):
+    start = time.perf_counter()
+    f(*args)
+    return time.perf_counter() - start
+
+
+def main():
+    n = int(sys.argv[1]) if len(sys.argv) > 1 else 10000
+    items = _generate_items(n)
+    before = _run('full items', items, None)
+    after = _run('declared attributes', items, lambda_function._get_attributes(None))
+    narrow = _run('fields=symbol,datetime', items, lambda_function._get_attributes(['symbol', 'datetime']))
+    for label, (size, elapsed) in [('declared attributes', after), ('fields=symbol,datetime', narrow)]:
+        print('{l:<28} {b:>5.1f}x fewer bytes, {t:>5.1f}x faster deserialization'.format(
+            l=label, b=before[0] / size, t=before[1] / elapsed))
+
+
+if __name__ == '__main__':
+    main()
@@ -6,6 +6,10 @@ cd package
 zip -r ../my-deployment-package.zip .
 cd ..
 zip -g my-deployment-package.zip lambda_function.py
+zip -g my-deployment-package.zip recent_price.py
+zip -g my-deployment-package.zip response_cache.py
+zip -g my-deployment-package.zip resilience.py
+zip -g my-deployment-package.zip rate_limit.py
 zip -g my-deployment-package.zip report.py
 zip -g my-deployment-package.zip report_email.py
 zip -g my-deployment-package.zip report_sms.py
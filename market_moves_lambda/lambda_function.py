@@ -1,25 +1,33 @@
 import boto3
-import datetime, decimal, json, pytz, threading
+import base64, bisect, collections, concurrent.futures, datetime, decimal, gzip, hashlib, json, os, pytz, threading
 from boto3.dynamodb.conditions import Key, Attr
-import os, requests
-
-_POLYGON_API_KEY = os.getenv('API_KEY_POLYGON')
-_URL_FORMAT = "https://api.polygon.io/v1/last/stocks/{symbol}?&apiKey={api_key}"
-
-_BINANCE_URL_FORMAT = 'https://api.binance.com/api/v3/avgPrice?symbol={symbol}'
+import recent_price, response_cache
+try:
+    import brotli
+except ImportError:
+    brotli = None
 
 _TIMEZONE_EASTERN = pytz.timezone('US/Eastern')
+_EPOCH_DATE = datetime.date(1970, 1, 1)
 
 _RESOURCE_DYNAMODB = 'dynamodb'
 _TABLE_NAME = 'financial_signal'
 _DATETIME_FORMAT = '%Y-%m-%dT%H:%M:%S%z'
 
 _EVENT_KEY_QUERY_STRING_PARAMETER = 'queryStringParameters'
+_EVENT_KEY_HEADERS = 'headers'
+_HEADER_KEY_ETAG = 'ETag'
+_HEADER_KEY_IF_NONE_MATCH = 'If-None-Match'
+_HEADER_KEY_ACCEPT_ENCODING = 'Accept-Encoding'
 _PARAM_KEY_FROM = 'from'
 _PARAM_KEY_TO = 'to'
 _PARAM_KEY_MARKET = 'market'
 _PARAM_KEY_SYMBOL = 'symbol'
+_PARAM_KEY_FIELDS = 'fields'
 _DATABASE_KEY_MARKET = 'market'
+_DATABASE_KEY_SYMBOL = 'symbol'
+_DATABASE_KEY_MARKET_DATE_ET = 'market_date_et'
+_DATABASE_KEY_MARKET_SYMBOL = 'market_symbol'
 _DATABASE_KEY_DATE_ET = 'date_et'
 _DATABASE_KEY_TIMESTAMP = 'timestamp'
 _DATABASE_KEY_MIN_DROP = 'min_drop'
@@ -28,6 +36,51 @@ _DATABASE_KEY_THRESHOLD = 'threshold'
 _DATABASE_KEY_WINDOW_SIZE_IN_MINUTES = 'window_size_minutes'
 _RESPONSE_KEY_DATE = 'date'
 _RESPONSE_KEY_DATETIME = 'datetime'
+_RESPONSE_KEY_RECENT_PRICE = 'recent_price'
+_HEADER_KEY_RECENT_PRICE_PARTIAL = 'X-Recent-Price-Partial'
+_MAX_QUERY_WORKERS = 8
+_MAX_RESULT_ITEMS = 30
+_QUERY_PAGE_LIMIT = int(os.getenv('MARKET_MOVES_QUERY_PAGE_LIMIT', '200'))
+# from/to are widened to this bucket so the requests within a bucket share a cached response, 0 disables the cache.
+_RESPONSE_CACHE_BUCKET_SECONDS = int(os.getenv('MARKET_MOVES_RESPONSE_CACHE_BUCKET_SECONDS', '30'))
+_MAX_ITEMS_PER_DAY = int(os.getenv('MARKET_MOVES_MAX_ITEMS_PER_DAY', '10000'))
+_MAX_RANGE_DAYS = int(os.getenv('MARKET_MOVES_MAX_RANGE_DAYS', '31'))
+# older date_et partitions whose first page is queried ahead once the newer ones come up short.
+_PREFETCH_PARTITIONS = max(1, int(os.getenv('MARKET_MOVES_PREFETCH_PARTITIONS', '2')))
+# bodies shorter than this are not worth the cpu, they fit in a few packets anyway.
+_COMPRESS_MIN_BYTES = int(os.getenv('MARKET_MOVES_COMPRESS_MIN_BYTES', '1400'))
+_GZIP_LEVEL = int(os.getenv('MARKET_MOVES_GZIP_LEVEL', '6'))
+_BROTLI_QUALITY = int(os.getenv('MARKET_MOVES_BROTLI_QUALITY', '5'))
+_INDEX_NAME_MARKET_DATE_ET = 'market_date_et-index'
+# the index is keyed on market_date_et ('<market>#<date_et>') and timestamp, see backfill_index.py.
+_USE_MARKET_DATE_ET_INDEX = os.getenv('MARKET_MOVES_USE_MARKET_DATE_ET_INDEX', '0') == '1'
+_INDEX_NAME_MARKET_SYMBOL = 'market_symbol-index'
+# the index is keyed on market_symbol ('<market>#<symbol>') and timestamp, see backfill_index.py.
+_USE_MARKET_SYMBOL_INDEX = os.getenv('MARKET_MOVES_USE_MARKET_SYMBOL_INDEX', '0') == '1'
+
+# the attributes read off the table, more can be added with MARKET_MOVES_EXTRA_ATTRIBUTES (comma separated).
+_DATABASE_ATTRIBUTES = [
+    _DATABASE_KEY_MARKET, _DATABASE_KEY_SYMBOL, _DATABASE_KEY_DATE_ET, _DATABASE_KEY_TIMESTAMP,
+    _DATABASE_KEY_MIN_DROP, _DATABASE_KEY_MAX_JUMP, _DATABASE_KEY_THRESHOLD, _DATABASE_KEY_WINDOW_SIZE_IN_MINUTES,
+] + [a for a in os.getenv('MARKET_MOVES_EXTRA_ATTRIBUTES', '').split(',') if a]
+# the rows are filtered on market and timestamp, and the recent prices are looked up by symbol.
+_REQUIRED_DATABASE_ATTRIBUTES = [_DATABASE_KEY_MARKET, _DATABASE_KEY_TIMESTAMP, _DATABASE_KEY_SYMBOL]
+_RESPONSE_KEY_TO_DATABASE_KEY = {
+    _RESPONSE_KEY_DATE: _DATABASE_KEY_DATE_ET,
+    _RESPONSE_KEY_DATETIME: _DATABASE_KEY_TIMESTAMP,
+}
+
+_thread_local = threading.local()
+_query_executor = None
+
+_RESPONSE_400 = {
+        'statusCode': 400,
+        'headers': {
+            'Access-Control-Allow-Headers': 'Content-Type',
+            'Access-Control-Allow-Origin': '*',
+            'Access-Control-Allow-Methods': 'OPTIONS,POST,GET'
+        }
+    }
 
 
 class DecimalEncoder(json.JSONEncoder):
@@ -40,115 +93,361 @@ class DecimalEncoder(json.JSONEncoder):
         return json.JSONEncoder.default(self, obj)
 
 
-def dict_to_response(blob):
-    ret = {}
-    for k, v in blob.items():
-        key = k
-        val = v
-        if k == _DATABASE_KEY_MIN_DROP or k == _DATABASE_KEY_MAX_JUMP:
-            val = float(v)
-
-        if k == _DATABASE_KEY_DATE_ET:
-            key = _RESPONSE_KEY_DATE
-        ret[key] = val
-
-        if k == _DATABASE_KEY_TIMESTAMP:
-            key = _RESPONSE_KEY_DATETIME
-            utc_dt = datetime.datetime.utcfromtimestamp(int(v))
-            aware_utc_dt = utc_dt.replace(tzinfo=pytz.utc)
-            dt = aware_utc_dt.astimezone(_TIMEZONE_EASTERN)
-            ret[key] = dt.strftime('%Y-%m-%dT%H:%M:%S%z')
+def _get_utc_offset_transitions(tz):
+    '''
+    Returns the epochs at which the utc offset of `tz` changes and the offsets (seconds) from then on.
+    '''
+    epoch = datetime.datetime(1970, 1, 1)
+    transition_epochs = [int((t - epoch).total_seconds()) for t in tz._utc_transition_times]
+    offsets = [int(info[0].total_seconds()) for info in tz._transition_info]
+    return transition_epochs, offsets
+
+
+# pytz keeps the transitions of US/Eastern up to 2037.
+_ET_TRANSITION_EPOCHS, _ET_OFFSETS = _get_utc_offset_transitions(_TIMEZONE_EASTERN)
+_ET_OFFSET_STRS = {o: '{s}{h:02d}{m:02d}'.format(s='-' if o < 0 else '+', h=abs(o) // 3600, m=abs(o) % 3600 // 60) for o in set(_ET_OFFSETS)}
+_RESPONSE_KEYS = {_DATABASE_KEY_DATE_ET: _RESPONSE_KEY_DATE}
+_FLOAT_KEYS = (_DATABASE_KEY_MIN_DROP, _DATABASE_KEY_MAX_JUMP)
+_SECONDS_IN_DAY = 24 * 3600
+
+
+def epochs_to_et_strs(epochs):
+    '''
+    Formats the epochs as ET datetimes in _DATETIME_FORMAT, same as strftime on the astimezone(US/Eastern) of each.
+
+    The utc offset comes from the precomputed transition table, and the date part is formatted once per day.
+    '''
+    ret = []
+    date_strs = {}
+    lo, hi = 0, -1
+    for epoch in epochs:
+        # the epochs are mostly sorted, so the transition of the previous one usually applies.
+        if not (lo <= epoch < hi):
+            i = bisect.bisect_right(_ET_TRANSITION_EPOCHS, epoch) - 1
+            lo = _ET_TRANSITION_EPOCHS[i]
+            hi = _ET_TRANSITION_EPOCHS[i + 1] if i + 1 < len(_ET_TRANSITION_EPOCHS) else float('inf')
+            offset = _ET_OFFSETS[i]
+            offset_str = _ET_OFFSET_STRS[offset]
+        days, seconds = divmod(epoch + offset, _SECONDS_IN_DAY)
+        date_str = date_strs.get(days)
+        if date_str is None:
+            date_str = date_strs[days] = (_EPOCH_DATE + datetime.timedelta(days=days)).strftime('%Y-%m-%d')
+        ret.append('%sT%02d:%02d:%02d%s' % (date_str, seconds // 3600, seconds % 3600 // 60, seconds % 60, offset_str))
+    return ret
+
+
+def dicts_to_response(blobs):
+    '''
+    Same as dict_to_response over a list of rows, with the timestamps converted together.
+    '''
+    datetime_strs = iter(epochs_to_et_strs([int(blob[_DATABASE_KEY_TIMESTAMP]) for blob in blobs if _DATABASE_KEY_TIMESTAMP in blob]))
+    ret = []
+    for blob in blobs:
+        r = {_RESPONSE_KEYS.get(k, k): v for k, v in blob.items()}
+        for k in _FLOAT_KEYS:
+            if k in r:
+                r[k] = float(r[k])
+        if _DATABASE_KEY_TIMESTAMP in blob:
+            r[_RESPONSE_KEY_DATETIME] = next(datetime_strs)
+        ret.append(r)
     return ret
 
 
-def _get_items(date_str, from_epoch, to_epoch, market, symbol):
-    dynamodb = boto3.resource(_RESOURCE_DYNAMODB)
-    table = dynamodb.Table(_TABLE_NAME)
+def dict_to_response(blob):
+    return dicts_to_response([blob])[0]
+
+
+def _get_table():
+    '''
+    Returns the table for the calling thread, as boto3 resources are not thread safe.
+    '''
+    if not hasattr(_thread_local, 'table'):
+        _thread_local.table = boto3.session.Session().resource(_RESOURCE_DYNAMODB).Table(_TABLE_NAME)
+    return _thread_local.table
+
+
+def get_query_executor():
+    global _query_executor
+    if _query_executor is None:
+        _query_executor = concurrent.futures.ThreadPoolExecutor(max_workers=_MAX_QUERY_WORKERS, thread_name_prefix='query')
+    return _query_executor
+
+
+def get_market_date_et(market, date_str):
+    return '{m}#{d}'.format(m=market, d=date_str)
+
+
+def get_market_symbol(market, symbol):
+    return '{m}#{s}'.format(m=market, s=symbol)
+
+
+def _get_attributes(fields):
+    '''
+    Returns the attributes to read for the response `fields`, all the declared attributes if no fields are given.
+    '''
+    if not fields:
+        return list(_DATABASE_ATTRIBUTES)
+    attributes = [_RESPONSE_KEY_TO_DATABASE_KEY.get(f, f) for f in fields]
+    attributes = [a for a in _DATABASE_ATTRIBUTES if a in attributes or a in _REQUIRED_DATABASE_ATTRIBUTES]
+    return attributes
+
+
+def _get_projection(attributes):
+    '''
+    Returns the ProjectionExpression and its ExpressionAttributeNames, with placeholders for every
+    attribute as some of them (timestamp) are reserved words.
+    '''
+    names = {'#p{i}'.format(i=i): a for i, a in enumerate(attributes)}
+    return ','.join(names.keys()), names
+
+
+def _query_page(key_condition_expression, index_name, from_epoch, to_epoch, market, symbol, attributes, exclusive_start_key):
+    table = _get_table()
 
+    filter_expression = ~Attr(_DATABASE_KEY_THRESHOLD).eq('0.05') & ~Attr(_DATABASE_KEY_WINDOW_SIZE_IN_MINUTES).eq(360)
     if symbol:
-        response = table.query(
-            KeyConditionExpression=Key(_DATABASE_KEY_DATE_ET).eq(date_str) & Key(_DATABASE_KEY_TIMESTAMP).between(
-                from_epoch, to_epoch),
-            FilterExpression=Attr(_PARAM_KEY_SYMBOL).eq(symbol) & ~Attr(_DATABASE_KEY_THRESHOLD).eq('0.05') & ~Attr(_DATABASE_KEY_WINDOW_SIZE_IN_MINUTES).eq(360)
-        )
-    else:
-        response = table.query(
-            KeyConditionExpression=Key(_DATABASE_KEY_DATE_ET).eq(date_str) & Key(_DATABASE_KEY_TIMESTAMP).between(
-                from_epoch, to_epoch),
-            FilterExpression=~Attr(_DATABASE_KEY_THRESHOLD).eq('0.05') & ~Attr(_DATABASE_KEY_WINDOW_SIZE_IN_MINUTES).eq(360)
-        )
+        filter_expression = Attr(_PARAM_KEY_SYMBOL).eq(symbol) & filter_expression
+    query_kwargs = {
+        'KeyConditionExpression': key_condition_expression,
+        'FilterExpression': filter_expression,
+        'ScanIndexForward': False,
+        'Limit': _QUERY_PAGE_LIMIT,
+    }
+    query_kwargs['ProjectionExpression'], query_kwargs['ExpressionAttributeNames'] = _get_projection(attributes)
+    if index_name:
+        query_kwargs['IndexName'] = index_name
+    if exclusive_start_key:
+        query_kwargs['ExclusiveStartKey'] = exclusive_start_key
 
+    response = table.query(**query_kwargs)
     items = response['Items']
     items = [i for i in items if i[_DATABASE_KEY_MARKET] == market]
     items = [i for i in items if i[_DATABASE_KEY_TIMESTAMP] >= from_epoch and i[_DATABASE_KEY_TIMESTAMP] <= to_epoch]
-    return items
-
-def _get_recent_price_binance(symbol):
-    url = _BINANCE_URL_FORMAT.format(symbol = symbol)
-    r = requests.get(url)
-    if not r.ok:
-        print(r.reason)
-        return 0
-    js = r.json()
-    return round(float(js['price']), 2)
-
-
-def _get_recent_price_symbol(symbol):
-    print('getting the recent price of {s}'.format(s=symbol))
-    url = _URL_FORMAT.format(symbol=symbol, api_key=_POLYGON_API_KEY)
-    r = requests.get(url)
-    if not r.ok:
-        print(r.reason)
-        return 0
-    js = r.json()
-    if 'last' not in js:
-        print('the key last not in', js)
-        return 0
-    if 'price' not in js['last']:
-        print('the key price not in the last price', js)
-        return 0
-    return js['last']['price']
-
-
-def _get_recent_price(recent_prices, recent_prices_lock, market, symbol):
-    with recent_prices_lock:
-        if market == 'binance':
-            recent_prices[symbol] = _get_recent_price_binance(symbol)
+    return items, response.get('LastEvaluatedKey'), response.get('ScannedCount', 0)
+
+
+def _get_page(date_str, from_epoch, to_epoch, market, symbol, attributes, exclusive_start_key=None):
+    '''
+    Returns one page of the `date_str` partition within the range, newest first, the key
+    to continue from (None once the partition is exhausted) and the number of rows read.
+
+    With the market_date_et index only the rows of the market are read.
+    '''
+    if _USE_MARKET_DATE_ET_INDEX:
+        index_name = _INDEX_NAME_MARKET_DATE_ET
+        partition_key = Key(_DATABASE_KEY_MARKET_DATE_ET).eq(get_market_date_et(market, date_str))
+    else:
+        index_name = None
+        partition_key = Key(_DATABASE_KEY_DATE_ET).eq(date_str)
+    key_condition_expression = partition_key & Key(_DATABASE_KEY_TIMESTAMP).between(from_epoch, to_epoch)
+    return _query_page(key_condition_expression, index_name, from_epoch, to_epoch, market, symbol, attributes, exclusive_start_key)
+
+
+def _get_symbol_page(from_epoch, to_epoch, market, symbol, attributes, exclusive_start_key=None):
+    '''
+    Same as `_get_page` for the rows of a single symbol over the whole range, from the market_symbol index.
+    '''
+    key_condition_expression = Key(_DATABASE_KEY_MARKET_SYMBOL).eq(get_market_symbol(market, symbol)) & Key(_DATABASE_KEY_TIMESTAMP).between(
+        from_epoch, to_epoch)
+    return _query_page(key_condition_expression, _INDEX_NAME_MARKET_SYMBOL, from_epoch, to_epoch, market, symbol, attributes, exclusive_start_key)
+
+
+def _get_date_strs(from_epoch, to_epoch):
+    '''
+    Returns the date_et partitions covering the range.
+    '''
+    date_et = _epoch_to_et(from_epoch).date()
+    date_et_to = _epoch_to_et(to_epoch).date()
+    date_strs = []
+    while date_et <= date_et_to:
+        date_strs.append(date_et.strftime('%Y-%m-%d'))
+        date_et += datetime.timedelta(days=1)
+    return date_strs
+
+
+def _get_newest_items(from_epoch, to_epoch, market, symbol, attributes, n):
+    '''
+    Returns up to `n` newest items of the range, newest first.
+
+    The partitions are consumed from the newest one, reading further pages only until `n` items
+    are collected. The newest partition is queried alone, the first pages of the older ones are
+    only prefetched, `_PREFETCH_PARTITIONS` ahead, once it comes up short.
+    '''
+    date_strs = _get_date_strs(from_epoch, to_epoch)[::-1]
+    print("date_strs:", date_strs)
+    executor = get_query_executor()
+    first_pages = collections.deque()
+
+    def prefetch(i):
+        while len(first_pages) < _PREFETCH_PARTITIONS and i + len(first_pages) < len(date_strs):
+            date_str = date_strs[i + len(first_pages)]
+            first_pages.append(executor.submit(_get_page, date_str, from_epoch, to_epoch, market, symbol, attributes))
+
+    items = []
+    for i, date_str in enumerate(date_strs):
+        if i == 0:
+            page_items, last_evaluated_key, scanned = _get_page(date_str, from_epoch, to_epoch, market, symbol, attributes)
         else:
-            recent_prices[symbol] = _get_recent_price_symbol(symbol)
+            prefetch(i)
+            page_items, last_evaluated_key, scanned = first_pages.popleft().result()
+        items += page_items
+        while len(items) < n and last_evaluated_key is not None:
+            if scanned >= _MAX_ITEMS_PER_DAY:
+                print('stopped reading {d} after {s} items'.format(d=date_str, s=scanned))
+                break
+            page_items, last_evaluated_key, page_scanned = _get_page(date_str, from_epoch, to_epoch, market, symbol, attributes, last_evaluated_key)
+            items += page_items
+            scanned += page_scanned
+        if len(items) >= n:
+            break
+        prefetch(i + 1)
+
+    for first_page in first_pages:
+        first_page.cancel()
+    return items[:n]
+
+
+def _get_newest_symbol_items(from_epoch, to_epoch, market, symbol, attributes, n):
+    '''
+    Returns up to `n` newest items of the symbol in the range, newest first, reading only the
+    rows of that symbol regardless of how many days the range spans.
+    '''
+    items, last_evaluated_key, scanned = _get_symbol_page(from_epoch, to_epoch, market, symbol, attributes)
+    while len(items) < n and last_evaluated_key is not None:
+        if scanned >= _MAX_ITEMS_PER_DAY:
+            print('stopped reading {s} after {c} items'.format(s=symbol, c=scanned))
+            break
+        page_items, last_evaluated_key, page_scanned = _get_symbol_page(from_epoch, to_epoch, market, symbol, attributes, last_evaluated_key)
+        items += page_items
+        scanned += page_scanned
+    return items[:n]
+
+
+def _epoch_to_et(epoch):
+    return datetime.datetime.fromtimestamp(epoch, tz=pytz.utc).astimezone(_TIMEZONE_EASTERN)
+
+
+def _get_header(event, name):
+    headers = event.get(_EVENT_KEY_HEADERS) or {}
+    for k, v in headers.items():
+        if k.lower() == name.lower():
+            return v
+    return None
+
+
+def _with_etag(event, response):
+    '''
+    Sets the ETag of the response from a hash of its body, and answers 304 without the body
+    when the If-None-Match of the request already has it.
+    '''
+    etag = '"{h}"'.format(h=hashlib.sha1(response['body'].encode('utf-8')).hexdigest())
+    response['headers'][_HEADER_KEY_ETAG] = etag
+    if_none_match = _get_header(event, _HEADER_KEY_IF_NONE_MATCH)
+    if if_none_match:
+        etags = [t.strip().replace('W/', '', 1) for t in if_none_match.split(',')]
+        if etag in etags or '*' in etags:
+            return {'statusCode': 304, 'headers': response['headers']}
+    return response
+
+
+def _get_accepted_encodings(event):
+    '''
+    Returns the encodings of the Accept-Encoding of the request, leaving out the ones with q=0.
+    '''
+    accept_encoding = _get_header(event, _HEADER_KEY_ACCEPT_ENCODING) or ''
+    ret = set()
+    for token in accept_encoding.split(','):
+        encoding, _, params = token.partition(';')
+        q = params.strip().replace(' ', '')
+        try:
+            if q.startswith('q=') and float(q[2:]) == 0:
+                continue
+        except ValueError:
+            continue
+        if encoding.strip():
+            ret.add(encoding.strip().lower())
+    return ret
+
+
+def _with_encoding(event, response):
+    '''
+    Compresses the body with brotli or gzip when it is at least _COMPRESS_MIN_BYTES long and the
+    client accepts it, returning it base64 encoded as the API Gateway proxy response expects.
+
+    The ETag is made weak as the compressed body is the same content in another encoding.
+    '''
+    if 'body' not in response or len(response['body']) < _COMPRESS_MIN_BYTES:
+        return response
+    response['headers']['Vary'] = _HEADER_KEY_ACCEPT_ENCODING
+    accepted = _get_accepted_encodings(event)
+    if brotli is not None and 'br' in accepted:
+        encoding = 'br'
+        body = brotli.compress(response['body'].encode('utf-8'), quality=_BROTLI_QUALITY)
+    elif 'gzip' in accepted or '*' in accepted:
+        encoding = 'gzip'
+        body = gzip.compress(response['body'].encode('utf-8'), compresslevel=_GZIP_LEVEL)
+    else:
+        return response
+
+    response['headers']['Content-Encoding'] = encoding
+    if _HEADER_KEY_ETAG in response['headers'] and not response['headers'][_HEADER_KEY_ETAG].startswith('W/'):
+        response['headers'][_HEADER_KEY_ETAG] = 'W/' + response['headers'][_HEADER_KEY_ETAG]
+    response['body'] = base64.b64encode(body).decode('ascii')
+    response['isBase64Encoded'] = True
+    return response
+
+
+def _get_response_rows(from_epoch, to_epoch, market, symbol, fields):
+    '''
+    Returns the response rows without the recent prices, from the response cache when the
+    same bucketed range was served recently.
+    '''
+    if _RESPONSE_CACHE_BUCKET_SECONDS <= 0:
+        return _query_response_rows(from_epoch, to_epoch, market, symbol, fields)
+
+    from_epoch -= from_epoch % _RESPONSE_CACHE_BUCKET_SECONDS
+    to_epoch += -to_epoch % _RESPONSE_CACHE_BUCKET_SECONDS
+    cache = response_cache.get_cache()
+    cache_key = (market, symbol, from_epoch, to_epoch, tuple(fields) if fields else None)
+    rows = cache.get(cache_key)
+    if rows is None:
+        rows = _query_response_rows(from_epoch, to_epoch, market, symbol, fields)
+        cache.put(cache_key, rows, len(json.dumps(rows, cls=DecimalEncoder)))
+    print('response cache:', cache.stats())
+    return rows
+
+
+def _query_response_rows(from_epoch, to_epoch, market, symbol, fields):
+    attributes = _get_attributes(fields)
+    if symbol and _USE_MARKET_SYMBOL_INDEX:
+        items = _get_newest_symbol_items(from_epoch, to_epoch, market, symbol, attributes, _MAX_RESULT_ITEMS)
+    else:
+        items = _get_newest_items(from_epoch, to_epoch, market, symbol, attributes, _MAX_RESULT_ITEMS)
+
+    # the items are already newest first.
+    return dicts_to_response(items)
+
 
 def _add_recent_prices(market, result):
     '''
     Adds "recent_price" fields to the entries of the given `result`.
+
+    Returns False if some of the prices did not arrive in time, in which case those entries get 0.
     '''
-    recent_prices ={}
-    recent_prices_lock = threading.Lock()
-    threads = list()
-
-    symbols = list(set([e['symbol'] for e in result]))
-    b = 0
-    batch_size = 40
-    while b * batch_size < len(symbols):
-        print('batch:', b)
-        b_head = b * batch_size
-        for bi, symbol in enumerate(symbols[b_head : b_head + batch_size]):
-            x = threading.Thread(target=_get_recent_price,
-                                 args=(recent_prices, recent_prices_lock, market, symbol,))
-            threads.append(x)
-            x.start()
-
-        for thread in threads:
-            thread.join()
-        b += 1
+    recent_prices, complete = recent_price.get_recent_prices(market, [e['symbol'] for e in result])
 
     for i, entry in enumerate(result):
-        entry['recent_price'] = recent_prices[entry['symbol']]
+        entry[_RESPONSE_KEY_RECENT_PRICE] = recent_prices.get(entry['symbol'], 0)
+    return complete
 
 def lambda_handler(event, context):
     query_string_parameters = event[_EVENT_KEY_QUERY_STRING_PARAMETER]
     print("query_string_parameters:", query_string_parameters)
     market = 'stock'
     symbol = None
+    from_epoch = None
+    to_epoch = None
+    fields = None
 
     if query_string_parameters:
         if _PARAM_KEY_MARKET in query_string_parameters:
@@ -157,48 +456,60 @@ def lambda_handler(event, context):
         if _PARAM_KEY_SYMBOL in query_string_parameters:
             symbol = query_string_parameters[_PARAM_KEY_SYMBOL]
 
-        if _PARAM_KEY_FROM in query_string_parameters:
-            t = datetime.datetime.strptime(query_string_parameters[_PARAM_KEY_FROM], _DATETIME_FORMAT)
-            from_epoch = int(t.timestamp())
+        if _PARAM_KEY_FIELDS in query_string_parameters:
+            fields = [f for f in query_string_parameters[_PARAM_KEY_FIELDS].split(',') if f]
 
-        if _PARAM_KEY_TO in query_string_parameters:
-            t = datetime.datetime.strptime(query_string_parameters[_PARAM_KEY_TO], _DATETIME_FORMAT)
-            to_epoch = int(t.timestamp())
+        try:
+            if _PARAM_KEY_FROM in query_string_parameters:
+                t = datetime.datetime.strptime(query_string_parameters[_PARAM_KEY_FROM], _DATETIME_FORMAT)
+                from_epoch = int(t.timestamp())
+
+            if _PARAM_KEY_TO in query_string_parameters:
+                t = datetime.datetime.strptime(query_string_parameters[_PARAM_KEY_TO], _DATETIME_FORMAT)
+                to_epoch = int(t.timestamp())
+        except ValueError as ex:
+            res = dict(_RESPONSE_400)
+            res['body'] = json.dumps('from/to should be formatted as {f}: {e}'.format(f=_DATETIME_FORMAT, e=ex))
+            return res
 
     if market == 'stock':
         market = 'polygon' # stock is ingested from polygon
     print("market:", market)
 
-    from_t = datetime.datetime.now() - datetime.timedelta(hours=24)
-    while market == 'stock' and from_t.weekday() >= 5:
-        from_t -= datetime.timedelta(hours=24)
-    from_epoch = int(from_t.timestamp())
-    to_epoch = int(datetime.datetime.now().timestamp())
+    if to_epoch is None:
+        to_epoch = int(datetime.datetime.now().timestamp())
+    if from_epoch is None:
+        from_t = datetime.datetime.fromtimestamp(to_epoch) - datetime.timedelta(hours=24)
+        while market == 'stock' and from_t.weekday() >= 5:
+            from_t -= datetime.timedelta(hours=24)
+        from_epoch = int(from_t.timestamp())
     print("from_epoch:", from_epoch, ", to_epoch:", to_epoch)
 
-    items = []
-    t = datetime.datetime.fromtimestamp(from_epoch)
-    date_str = t.strftime('%Y-%m-%d')
-    date_str_to = datetime.datetime.fromtimestamp(to_epoch).strftime('%Y-%m-%d')
-    print("date_str_to:", date_str_to)
-    while True:
-        print("date_str:", date_str)
-        items += _get_items(date_str, from_epoch, to_epoch, market, symbol)
-        if date_str == date_str_to:
-            break
-        t += datetime.timedelta(days=1)
-        date_str = t.strftime('%Y-%m-%d')
-
-    result = list(map(lambda blob: dict_to_response(blob), items))
-    result.sort(key=lambda blob: blob[_RESPONSE_KEY_DATETIME], reverse=True)
-    result = result[:30]
-    _add_recent_prices(market, result)
-    return {
+    if from_epoch > to_epoch:
+        res = dict(_RESPONSE_400)
+        res['body'] = json.dumps('from should not be after to.')
+        return res
+    if to_epoch - from_epoch > _MAX_RANGE_DAYS * 24 * 3600:
+        res = dict(_RESPONSE_400)
+        res['body'] = json.dumps('the range should not be longer than {d} days.'.format(d=_MAX_RANGE_DAYS))
+        return res
+
+    result = _get_response_rows(from_epoch, to_epoch, market, symbol, fields)
+    recent_prices_complete = True
+    if not fields or _RESPONSE_KEY_RECENT_PRICE in fields:
+        recent_prices_complete = _add_recent_prices(market, result)
+    if fields:
+        result = [{k: v for k, v in entry.items() if k in fields} for entry in result]
+    headers = {
+        'Access-Control-Allow-Headers': 'Content-Type',
+        'Access-Control-Allow-Origin': '*',
+        'Access-Control-Allow-Methods': 'OPTIONS,POST,GET',
+        'Access-Control-Expose-Headers': ','.join([_HEADER_KEY_RECENT_PRICE_PARTIAL, _HEADER_KEY_ETAG])
+    }
+    if not recent_prices_complete:
+        headers[_HEADER_KEY_RECENT_PRICE_PARTIAL] = 'true'
+    return _with_encoding(event, _with_etag(event, {
         'statusCode': 200,
-        'headers': {
-            'Access-Control-Allow-Headers': 'Content-Type',
-            'Access-Control-Allow-Origin': '*',
-            'Access-Control-Allow-Methods': 'OPTIONS,POST,GET'
-        },
+        'headers': headers,
         'body': json.dumps(result, cls=DecimalEncoder)
-    }
+    }))
@@ -0,0 +1,293 @@
+import collections, concurrent.futures, os, re, threading, time
+import requests
+from requests.adapters import HTTPAdapter
+import rate_limit, resilience
+
+_POLYGON_API_KEY = os.getenv('API_KEY_POLYGON')
+_URL_FORMAT = "https://api.polygon.io/v1/last/stocks/{symbol}?&apiKey={api_key}"
+
+_BINANCE_URL_FORMAT = 'https://api.binance.com/api/v3/avgPrice?symbol={symbol}'
+
+_POLYGON_SNAPSHOT_URL_FORMAT = 'https://api.polygon.io/v2/snapshot/locale/us/markets/stocks/tickers?tickers={symbols}&apiKey={api_key}'
+_BINANCE_TICKER_PRICE_URL = 'https://api.binance.com/api/v3/ticker/price'
+# request weights of the binance endpoints.
+_BINANCE_AVG_PRICE_WEIGHT = 2
+_BINANCE_TICKER_PRICE_ALL_WEIGHT = 4
+
+_MAX_WORKERS = int(os.getenv('RECENT_PRICE_MAX_WORKERS', '32'))
+_DEADLINE_SECONDS = float(os.getenv('RECENT_PRICE_DEADLINE_SECONDS', '4'))
+_CACHE_MAX_ENTRIES = int(os.getenv('RECENT_PRICE_CACHE_MAX_ENTRIES', '8192'))
+_STALENESS_SECONDS = {
+    'binance': float(os.getenv('RECENT_PRICE_STALENESS_SECONDS_BINANCE', '2')),
+    'polygon': float(os.getenv('RECENT_PRICE_STALENESS_SECONDS_POLYGON', '15')),
+}
+_DEFAULT_STALENESS_SECONDS = 5
+_BULK_ENABLED = os.getenv('RECENT_PRICE_BULK', '1') == '1'
+
+_session = None
+_executor = None
+_cache = None
+
+
+class RecentPriceCache:
+    '''
+    LRU of (market, symbol) to (price, fetched_at) kept by the warm container.
+
+    A price is served while it is younger than the staleness bound of its market. Callers that
+    miss on a symbol which is already being fetched wait on that fetch instead of starting another.
+    A bulk response is cached for all of its symbols.
+    '''
+    def __init__(self, max_entries=_CACHE_MAX_ENTRIES, staleness_seconds=_STALENESS_SECONDS):
+        self.max_entries = max_entries
+        self.staleness_seconds = staleness_seconds
+        self._entries = collections.OrderedDict()
+        self._in_flight = {}
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.shared_fetches = 0
+        self.evictions = 0
+
+    def _get_staleness_seconds(self, market):
+        return self.staleness_seconds.get(market, _DEFAULT_STALENESS_SECONDS)
+
+    def get(self, market, symbol):
+        '''
+        Returns the cached price if it is fresh enough, else None.
+        '''
+        key = (market, symbol)
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None or time.time() - entry[1] > self._get_staleness_seconds(market):
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return entry[0]
+
+    def _put_locked(self, key, price, fetched_at):
+        # 0 is what a failed fetch returns, that should be retried rather than served.
+        if not price:
+            return
+        self._entries[key] = (price, fetched_at)
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.max_entries:
+            self._entries.popitem(last=False)
+            self.evictions += 1
+
+    def put_many(self, market, prices):
+        now = time.time()
+        with self._lock:
+            for symbol, price in prices.items():
+                self._put_locked((market, symbol), price, now)
+
+    def submit_once(self, market, symbol, submit):
+        '''
+        Returns the future fetching the symbol, shared by every caller missing on it.
+        `submit` starts the fetch if none is running.
+        '''
+        key = (market, symbol)
+        with self._lock:
+            future = self._in_flight.get(key)
+            if future is not None:
+                self.shared_fetches += 1
+                return future
+            future = submit()
+            self._in_flight[key] = future
+        # outside of the lock as the callback runs right away if the fetch is already done.
+        future.add_done_callback(lambda f: self._on_fetched(key, f))
+        return future
+
+    def _on_fetched(self, key, future):
+        with self._lock:
+            self._in_flight.pop(key, None)
+            if future.cancelled() or future.exception() is not None:
+                return
+            self._put_locked(key, future.result(), time.time())
+
+    def stats(self):
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                'size': len(self._entries),
+                'hits': self.hits,
+                'misses': self.misses,
+                'hit_ratio': round(self.hits / lookups, 3) if lookups else 0,
+                'shared_fetches': self.shared_fetches,
+                'evictions': self.evictions,
+            }
+
+
+def get_session():
+    '''
+    Returns the http session shared by the warm container so the connections to the exchanges are kept alive.
+    '''
+    global _session
+    if _session is None:
+        _session = requests.Session()
+        _session.mount('https://', HTTPAdapter(pool_connections=4, pool_maxsize=_MAX_WORKERS))
+    return _session
+
+
+def get_executor():
+    global _executor
+    if _executor is None:
+        _executor = concurrent.futures.ThreadPoolExecutor(max_workers=_MAX_WORKERS, thread_name_prefix='recent_price')
+    return _executor
+
+
+def get_cache():
+    global _cache
+    if _cache is None:
+        _cache = RecentPriceCache()
+    return _cache
+
+
+def _redact(ex):
+    '''
+    Returns the message of the exception without the polygon api key, which the failed url carries.
+    '''
+    return re.sub(r'apiKey=[^&\s]*', 'apiKey=***', str(ex))
+
+
+def _get(url, weight=1):
+    '''
+    GETs the url once the rate limit of its host lets it through, with the per host timeout,
+    hedging and circuit breaker of resilience.
+    '''
+    bucket = rate_limit.get_bucket(url)
+    attempts = []
+
+    def send(timeout_seconds):
+        # the first attempt waited for its tokens, a hedged duplicate is charged without waiting.
+        if attempts:
+            bucket.reserve(weight)
+        attempts.append(timeout_seconds)
+        r = get_session().get(url, timeout=timeout_seconds)
+        bucket.on_response(r.status_code, r.headers)
+        return r
+
+    bucket.acquire(weight)
+    return resilience.get(url, send)
+
+
+def _get_recent_price_binance(symbol):
+    url = _BINANCE_URL_FORMAT.format(symbol = symbol)
+    r = _get(url, weight=_BINANCE_AVG_PRICE_WEIGHT)
+    if not r.ok:
+        print(r.reason)
+        return 0
+    js = r.json()
+    return round(float(js['price']), 2)
+
+
+def _get_recent_price_symbol(symbol):
+    print('getting the recent price of {s}'.format(s=symbol))
+    url = _URL_FORMAT.format(symbol=symbol, api_key=_POLYGON_API_KEY)
+    r = _get(url)
+    if not r.ok:
+        print(r.reason)
+        return 0
+    js = r.json()
+    if 'last' not in js:
+        print('the key last not in', js)
+        return 0
+    if 'price' not in js['last']:
+        print('the key price not in the last price', js)
+        return 0
+    return js['last']['price']
+
+
+def get_recent_price(market, symbol):
+    try:
+        if market == 'binance':
+            return _get_recent_price_binance(symbol)
+        return _get_recent_price_symbol(symbol)
+    except (requests.RequestException, resilience.CircuitOpenError) as ex:
+        print('could not get the recent price of {s}:'.format(s=symbol), _redact(ex))
+        return 0
+
+
+def _get_recent_prices_binance_bulk():
+    r = _get(_BINANCE_TICKER_PRICE_URL, weight=_BINANCE_TICKER_PRICE_ALL_WEIGHT)
+    if not r.ok:
+        print(r.reason)
+        return {}
+    return {t['symbol']: round(float(t['price']), 2) for t in r.json()}
+
+
+def _get_recent_prices_polygon_bulk(symbols):
+    url = _POLYGON_SNAPSHOT_URL_FORMAT.format(symbols=','.join(sorted(symbols)), api_key=_POLYGON_API_KEY)
+    r = _get(url)
+    if not r.ok:
+        print(r.reason)
+        return {}
+    ret = {}
+    for t in r.json().get('tickers') or []:
+        price = (t.get('lastTrade') or {}).get('p') or (t.get('min') or {}).get('c')
+        if price:
+            ret[t['ticker']] = price
+    return ret
+
+
+def get_recent_prices_bulk(market, symbols):
+    '''
+    Returns the recent prices of the market with a single request, as a dict of symbol to price.
+
+    Binance returns every symbol of the exchange, polygon the snapshot of the given `symbols`.
+    '''
+    try:
+        if market == 'binance':
+            return _get_recent_prices_binance_bulk()
+        return _get_recent_prices_polygon_bulk(symbols)
+    except (requests.RequestException, resilience.CircuitOpenError, ValueError, KeyError) as ex:
+        print('could not get the recent prices in bulk:', _redact(ex))
+        return {}
+
+
+def get_recent_prices(market, symbols, deadline_seconds=_DEADLINE_SECONDS):
+    '''
+    Returns the recent prices of the given `symbols`, from the cache when fresh enough, else from
+    one bulk request for the market, and fetched concurrently per symbol for the rest.
+
+    Returns a dict of symbol to price, and whether every symbol finished within `deadline_seconds`.
+    The symbols that did not finish in time are absent from the dict.
+    '''
+    executor = get_executor()
+    cache = get_cache()
+    recent_prices = {}
+    missing = []
+    for symbol in set(symbols):
+        price = cache.get(market, symbol)
+        if price is None:
+            missing.append(symbol)
+        else:
+            recent_prices[symbol] = price
+
+    if missing and _BULK_ENABLED:
+        bulk_prices = get_recent_prices_bulk(market, missing)
+        cache.put_many(market, bulk_prices)
+        for symbol in missing:
+            if bulk_prices.get(symbol):
+                recent_prices[symbol] = bulk_prices[symbol]
+        missing = [symbol for symbol in missing if symbol not in recent_prices]
+        if missing:
+            print('{n} symbols are missing from the bulk prices: {s}'.format(n=len(missing), s=','.join(missing)))
+
+    futures = {}
+    for symbol in missing:
+        future = cache.submit_once(market, symbol, lambda: executor.submit(get_recent_price, market, symbol))
+        futures[future] = symbol
+
+    done, not_done = concurrent.futures.wait(futures, timeout=deadline_seconds)
+    for future in done:
+        recent_prices[futures[future]] = future.result()
+
+    # the fetches that are still running are left alone, they fill the cache for the next request.
+    print('recent price cache:', cache.stats())
+    print('exchange hosts:', resilience.stats())
+    print('rate limits:', rate_limit.stats())
+    if not_done:
+        print('{n} recent prices did not arrive within {d}s: {s}'.format(
+            n=len(not_done), d=deadline_seconds, s=','.join(futures[f] for f in not_done)))
+    return recent_prices, not not_done
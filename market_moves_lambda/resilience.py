@@ -0,0 +1,246 @@
+'''
+Resilience of the GET requests to the exchanges, per host:
+
+- a timeout per host (EXCHANGE_HOST_TIMEOUTS='api.binance.com=3,api.polygon.io=5' overrides them),
+- a hedged duplicate of a request that has not answered after the p95 latency of its host,
+  the first answer wins,
+- a circuit breaker that fails the requests to a host right away with CircuitOpenError for
+  a cooldown after repeated failures, then lets one request through to probe it.
+
+`get` serves the blocking requests (requests), `get_async` the asyncio ones (aiohttp). The same
+file is shipped with every lambda that calls the exchanges.
+'''
+import asyncio, collections, concurrent.futures, os, threading, time, urllib.parse
+
+_HOST_TIMEOUT_SECONDS = {
+    'api.binance.com': 3,
+    'api.polygon.io': 5,
+    'www.okcoin.com': 5,
+    'api.kraken.com': 5,
+}
+_HOST_TIMEOUT_SECONDS.update({
+    host: float(seconds) for host, _, seconds in
+    (entry.partition('=') for entry in os.getenv('EXCHANGE_HOST_TIMEOUTS', '').split(',') if entry)
+})
+_DEFAULT_TIMEOUT_SECONDS = float(os.getenv('EXCHANGE_DEFAULT_TIMEOUT_SECONDS', '5'))
+_HEDGING_ENABLED = os.getenv('EXCHANGE_HEDGING', '1') == '1'
+_HEDGE_PERCENTILE = 0.95
+_HEDGE_MIN_SAMPLES = 20
+_HEDGE_MIN_DELAY_SECONDS = 0.05
+_LATENCY_SAMPLES = 200
+_BREAKER_FAILURE_THRESHOLD = int(os.getenv('EXCHANGE_BREAKER_FAILURE_THRESHOLD', '5'))
+_BREAKER_COOLDOWN_SECONDS = float(os.getenv('EXCHANGE_BREAKER_COOLDOWN_SECONDS', '30'))
+_MAX_WORKERS = int(os.getenv('EXCHANGE_HEDGE_MAX_WORKERS', '64'))
+
+_hosts = {}
+_hosts_lock = threading.Lock()
+_executor = None
+
+
+class CircuitOpenError(Exception):
+    pass
+
+
+class HostState:
+    '''
+    Latencies, circuit breaker and counters of a host.
+
+    The breaker opens after _BREAKER_FAILURE_THRESHOLD failures in a row (an exception, a 5xx or
+    a 429), stays open for _BREAKER_COOLDOWN_SECONDS, and then lets a single probe through which
+    closes it on success or opens it again on failure.
+    '''
+    def __init__(self, host):
+        self.host = host
+        self.timeout_seconds = _HOST_TIMEOUT_SECONDS.get(host, _DEFAULT_TIMEOUT_SECONDS)
+        self._latencies = collections.deque(maxlen=_LATENCY_SAMPLES)
+        self._lock = threading.Lock()
+        self._consecutive_failures = 0
+        self._opened_at = None
+        self._probing = False
+        self.requests = 0
+        self.failures = 0
+        self.hedges = 0
+        self.hedge_wins = 0
+        self.rejections = 0
+
+    def get_hedge_delay_seconds(self):
+        '''
+        Returns how long to wait for an answer before hedging, None to not hedge.
+        '''
+        if not _HEDGING_ENABLED:
+            return None
+        with self._lock:
+            if len(self._latencies) < _HEDGE_MIN_SAMPLES:
+                return self.timeout_seconds / 2
+            latencies = sorted(self._latencies)
+        p95 = latencies[int(len(latencies) * _HEDGE_PERCENTILE) - 1]
+        return min(max(p95, _HEDGE_MIN_DELAY_SECONDS), self.timeout_seconds / 2)
+
+    def before_request(self):
+        with self._lock:
+            self.requests += 1
+            if self._opened_at is None:
+                return
+            if time.monotonic() - self._opened_at < _BREAKER_COOLDOWN_SECONDS or self._probing:
+                self.rejections += 1
+                raise CircuitOpenError('the circuit of {h} is open after {n} failures.'.format(
+                    h=self.host, n=self._consecutive_failures))
+            self._probing = True
+
+    def on_hedge(self):
+        with self._lock:
+            self.hedges += 1
+
+    def on_latency(self, seconds):
+        with self._lock:
+            self._latencies.append(seconds)
+
+    def on_success(self, hedged_won=False):
+        with self._lock:
+            self._consecutive_failures = 0
+            self._opened_at = None
+            self._probing = False
+            if hedged_won:
+                self.hedge_wins += 1
+
+    def on_failure(self):
+        with self._lock:
+            self.failures += 1
+            self._consecutive_failures += 1
+            self._probing = False
+            if self._opened_at is not None or self._consecutive_failures >= _BREAKER_FAILURE_THRESHOLD:
+                if self._opened_at is None:
+                    print('opening the circuit of {h} after {n} failures.'.format(h=self.host, n=self._consecutive_failures))
+                self._opened_at = time.monotonic()
+
+    def stats(self):
+        with self._lock:
+            latencies = sorted(self._latencies)
+            return {
+                'host': self.host,
+                'requests': self.requests,
+                'failures': self.failures,
+                'hedges': self.hedges,
+                'hedge_wins': self.hedge_wins,
+                'rejections': self.rejections,
+                'open': self._opened_at is not None,
+                'p95_seconds': round(latencies[int(len(latencies) * _HEDGE_PERCENTILE) - 1], 3) if latencies else None,
+            }
+
+
+def get_host_state(url):
+    host = urllib.parse.urlsplit(url).hostname
+    with _hosts_lock:
+        if host not in _hosts:
+            _hosts[host] = HostState(host)
+        return _hosts[host]
+
+
+def stats():
+    with _hosts_lock:
+        states = list(_hosts.values())
+    return [state.stats() for state in states]
+
+
+def get_executor():
+    global _executor
+    if _executor is None:
+        _executor = concurrent.futures.ThreadPoolExecutor(max_workers=_MAX_WORKERS, thread_name_prefix='exchange_request')
+    return _executor
+
+
+def _is_failure(status):
+    return status >= 500 or status == 429
+
+
+def _send_timed(state, send):
+    start = time.monotonic()
+    response = send(state.timeout_seconds)
+    if not _is_failure(response.status_code):
+        state.on_latency(time.monotonic() - start)
+    return response
+
+
+def get(url, send):
+    '''
+    Returns the requests.Response of `send(timeout_seconds)`, a blocking GET of the url,
+    hedged with a second `send` if the first one is slower than the p95 of the host.
+
+    Raises CircuitOpenError while the circuit of the host is open, else what the last attempt raised.
+    '''
+    state = get_host_state(url)
+    state.before_request()
+    executor = get_executor()
+    futures = [executor.submit(_send_timed, state, send)]
+    hedge_delay_seconds = state.get_hedge_delay_seconds()
+    if hedge_delay_seconds is not None:
+        done, _ = concurrent.futures.wait(futures, timeout=hedge_delay_seconds)
+        if not done:
+            state.on_hedge()
+            futures.append(executor.submit(_send_timed, state, send))
+
+    pending = set(futures)
+    response, error = None, None
+    while pending:
+        done, pending = concurrent.futures.wait(pending, return_when=concurrent.futures.FIRST_COMPLETED)
+        for future in done:
+            if future.exception() is not None:
+                error = future.exception()
+                continue
+            response = future.result()
+            if not _is_failure(response.status_code):
+                # the slower attempt is left to finish in the background.
+                state.on_success(hedged_won=len(futures) > 1 and future is futures[1])
+                return response
+    state.on_failure()
+    if response is not None:
+        return response
+    raise error
+
+
+async def _send_async_timed(state, send):
+    start = time.monotonic()
+    status, payload = await asyncio.wait_for(send(state.timeout_seconds), state.timeout_seconds)
+    if not _is_failure(status):
+        state.on_latency(time.monotonic() - start)
+    return status, payload
+
+
+async def get_async(url, send):
+    '''
+    Returns the (status, payload) of the coroutine `send(timeout_seconds)`, a GET of the url,
+    hedged with a second `send` if the first one is slower than the p95 of the host. The
+    slower attempt is cancelled.
+
+    Raises CircuitOpenError while the circuit of the host is open, else what the last attempt raised.
+    '''
+    state = get_host_state(url)
+    state.before_request()
+    tasks = [asyncio.ensure_future(_send_async_timed(state, send))]
+    hedge_delay_seconds = state.get_hedge_delay_seconds()
+    if hedge_delay_seconds is not None:
+        done, _ = await asyncio.wait(tasks, timeout=hedge_delay_seconds)
+        if not done:
+            state.on_hedge()
+            tasks.append(asyncio.ensure_future(_send_async_timed(state, send)))
+
+    pending = set(tasks)
+    result, error = None, None
+    try:
+        while pending:
+            done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+            for task in done:
+                if task.exception() is not None:
+                    error = task.exception()
+                    continue
+                result = task.result()
+                if not _is_failure(result[0]):
+                    state.on_success(hedged_won=len(tasks) > 1 and task is tasks[1])
+                    return result
+    finally:
+        for task in pending:
+            task.cancel()
+    state.on_failure()
+    if result is not None:
+        return result
+    raise error
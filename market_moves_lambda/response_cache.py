@@ -0,0 +1,76 @@
+import collections, os, threading, time
+
+_MAX_ENTRIES = int(os.getenv('MARKET_MOVES_RESPONSE_CACHE_MAX_ENTRIES', '256'))
+_MAX_BYTES = int(os.getenv('MARKET_MOVES_RESPONSE_CACHE_MAX_BYTES', str(16 * 1024 * 1024)))
+_TTL_SECONDS = float(os.getenv('MARKET_MOVES_RESPONSE_CACHE_TTL_SECONDS', '30'))
+
+_cache = None
+
+
+class ResponseCache:
+    '''
+    LRU of response rows kept by the warm container, bounded by the number of entries and by
+    their approximate size (their length as json), with the entries expiring after ttl_seconds.
+
+    The rows are copied in and out so the callers can add fields to them without touching the cache.
+    '''
+    def __init__(self, max_entries=_MAX_ENTRIES, max_bytes=_MAX_BYTES, ttl_seconds=_TTL_SECONDS):
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.ttl_seconds = ttl_seconds
+        self._entries = collections.OrderedDict()
+        self._bytes = 0
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def get(self, key):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None or time.time() - entry[1] > self.ttl_seconds:
+                if entry is not None:
+                    self._remove_locked(key)
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return [dict(row) for row in entry[0]]
+
+    def put(self, key, rows, size):
+        '''
+        Caches the `rows` under the `key`, `size` is the length of the rows as json.
+        '''
+        if size > self.max_bytes:
+            return
+        with self._lock:
+            if key in self._entries:
+                self._remove_locked(key)
+            self._entries[key] = ([dict(row) for row in rows], time.time(), size)
+            self._bytes += size
+            while len(self._entries) > self.max_entries or self._bytes > self.max_bytes:
+                self._remove_locked(next(iter(self._entries)))
+                self.evictions += 1
+
+    def _remove_locked(self, key):
+        _, _, size = self._entries.pop(key)
+        self._bytes -= size
+
+    def stats(self):
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                'size': len(self._entries),
+                'bytes': self._bytes,
+                'hits': self.hits,
+                'misses': self.misses,
+                'hit_ratio': round(self.hits / lookups, 3) if lookups else 0,
+                'evictions': self.evictions,
+            }
+
+
+def get_cache():
+    global _cache
+    if _cache is None:
+        _cache = ResponseCache()
+    return _cache
@@ -9,5 +9,6 @@ zip -g my-deployment-package.zip lambda_function.py
 zip -g my-deployment-package.zip report.py
 zip -g my-deployment-package.zip report_email.py
 zip -g my-deployment-package.zip report_sms.py
+zip -g my-deployment-package.zip rate_limit.py
 aws s3 cp my-deployment-package.zip s3://market-signal-notification-lambda/
 aws lambda update-function-code --function-name MarketSignalNotification --s3-bucket market-signal-notification-lambda --s3-key my-deployment-package.zip
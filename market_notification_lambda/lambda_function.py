@@ -3,10 +3,12 @@ import json, re
 import boto3
 from boto3.dynamodb.conditions import Key, Attr
 import pytz
-import report_email, report_sms
+import rate_limit, report_email, report_sms
 
 stripe.api_key = os.getenv('STRIPE_SECRET_KEY') 
 
+_STRIPE_API_URL = 'https://api.stripe.com'
+
 _TIMEZONE_US_EAST = pytz.timezone('US/EASTERN')
 _DATETIME_FORMAT = '%Y-%m-%dT%H:%M:%S%z'
 
@@ -106,6 +108,7 @@ def get_stripe_customer_item_for_auth0_user(auth0_user_id):
     return items[0]
 
 def retrieve_stripe_customer_subscription(stripe_customer_id):
+  rate_limit.get_bucket(_STRIPE_API_URL).acquire()
   c = stripe.Customer.retrieve(stripe_customer_id)
   return c['subscriptions'] if 'subscriptions' in c else {}
 
@@ -228,6 +231,8 @@ def lambda_handler(event, context):
             max_jump_percent, price_at_max_jump, int(epoch_at_max_jump),
             window_minutes, threshold_percent, move_type)
 
+    print('rate limits:', rate_limit.stats())
+
     ret = {
         'emails': emails,
         'sms': smses
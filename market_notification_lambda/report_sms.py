@@ -1,12 +1,13 @@
 # Download the helper library from https://www.twilio.com/docs/python/install
 import os
-import report
+import rate_limit, report
 from twilio.rest import Client
 
 account_sid = os.environ['TWILIO_ACCOUNT_SID']
 auth_token = os.environ['TWILIO_AUTH_TOKEN']
 client = Client(account_sid, auth_token)
 _FROM_NUMBER = os.getenv('TWILIO_SENDER_NUMBER')
+_TWILIO_API_URL = 'https://api.twilio.com'
 
 
 def get_report_str(
@@ -48,6 +49,7 @@ def send_sms_report(
         max_jump_percent, price_at_max_jump, max_jump_epoch_seconds,
         window_minutes, threshold_percent, move_type)
 
+     rate_limit.get_bucket(_TWILIO_API_URL).acquire()
      message = client.messages \
                      .create(
                           body=sms_str,
@@ -0,0 +1,56 @@
+'''
+Benchmark of the response formats of market_price_history.
+
+Builds the body from synthetic binance klines at typical candle counts, timing the conversion off
+the upstream payload plus the encoding, for the rows and the columnar formats, as json and as
+MessagePack.
+
+    python benchmark_columnar.py
+'''
+import random, time
+import exchange_adapters, lambda_function
+
+_CANDLE_COUNTS = [60, 390, 1440, 4320]
+_REPEAT = 5
+
+
+def _generate_klines(n):
+    random.seed(0)
+    now = int(time.time()) // 60 * 60
+    price = 30000.0
+    klines = []
+    for i in range(n):
+        o = price
+        c = o * (1 + random.gauss(0, 0.001))
+        open_time = (now - (n - i) * 60) * 1000
+        klines.append([open_time, '%.2f' % o, '%.2f' % (max(o, c) * 1.0005), '%.2f' % (min(o, c) * 0.9995),
+                       '%.2f' % c, '%.6f' % (random.random() * 50), open_time + 59999, '0', 100, '0', '0', '0'])
+        price = c
+    return klines
+
+
+def _encode(klines, response_format, accept):
+    event = {'headers': {'Accept': accept}}
+    columns = exchange_adapters.get_adapter('binance').decode(klines)
+    return lambda_function._get_body(event, lambda_function._format_series(columns, response_format))
+
+
+def main():
+    cases = [('rows', 'json'), ('columnar', 'json')]
+    if lambda_function.msgpack is not None:
+        cases += [('rows', 'application/msgpack'), ('columnar', 'application/msgpack')]
+    print('{n:>7} {f:<9} {a:<20} {b:>10} {t:>9}'.format(n='candles', f='format', a='accept', b='bytes', t='ms'))
+    for n in _CANDLE_COUNTS:
+        klines = _generate_klines(n)
+        for response_format, accept in cases:
+            elapsed = []
+            for _ in range(_REPEAT):
+                start = time.perf_counter()
+                body, _, is_base64_encoded = _encode(klines, response_format, accept)
+                elapsed.append(time.perf_counter() - start)
+            print('{n:>7} {f:<9} {a:<20} {b:>10} {t:>9.2f}'.format(
+                n=n, f=response_format, a=accept, b=len(body), t=min(elapsed) * 1000))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,57 @@
+'''
+Benchmark of the compressed responses of market_price_history.
+
+Builds the json body of synthetic 1 minute candles at typical candle counts (an hour, a regular
+equity session, a day and 3 days of crypto) and reports the bytes on the wire (base64 included)
+and the time _with_encoding spends for identity, gzip and brotli.
+
+    python benchmark_compression.py
+'''
+import json, random, time
+import lambda_function
+
+_CANDLE_COUNTS = [60, 390, 1440, 4320]
+_ACCEPT_ENCODINGS = [('identity', 'identity'), ('gzip', 'gzip'), ('br', 'br')]
+_REPEAT = 5
+
+
+def _generate_candles(n):
+    random.seed(0)
+    now = int(time.time()) // 60 * 60
+    price = 30000.0
+    candles = []
+    for i in range(n):
+        o = price
+        c = o * (1 + random.gauss(0, 0.001))
+        candles.append({'o': round(o, 2), 'h': round(max(o, c) * 1.0005, 2), 'l': round(min(o, c) * 0.9995, 2),
+                        'c': round(c, 2), 'v': round(random.random() * 50, 6), 't': now - (n - i) * 60})
+        price = c
+    return candles
+
+
+def _encode(body, accept_encoding):
+    event = {'headers': {'Accept-Encoding': accept_encoding}}
+    response = {'statusCode': 200, 'headers': {}, 'body': body}
+    return lambda_function._with_encoding(event, response)
+
+
+def main():
+    print('{n:>7} {e:<9} {b:>10} {r:>7} {t:>9}'.format(n='candles', e='encoding', b='bytes', r='ratio', t='ms'))
+    for n in _CANDLE_COUNTS:
+        body = json.dumps(_generate_candles(n), cls=lambda_function.DecimalEncoder)
+        for label, accept_encoding in _ACCEPT_ENCODINGS:
+            if label == 'br' and lambda_function.brotli is None:
+                print('{n:>7} {e:<9} brotli is not installed'.format(n=n, e=label))
+                continue
+            elapsed = []
+            for _ in range(_REPEAT):
+                start = time.perf_counter()
+                response = _encode(body, accept_encoding)
+                elapsed.append(time.perf_counter() - start)
+            size = len(response['body'])
+            print('{n:>7} {e:<9} {b:>10} {r:>6.1f}x {t:>9.2f}'.format(
+                n=n, e=label, b=size, r=len(body) / size, t=min(elapsed) * 1000))
+
+
+if __name__ == '__main__':
+    main()
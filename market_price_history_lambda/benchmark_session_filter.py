@@ -0,0 +1,61 @@
+'''
+Benchmark of the regular session filter of the equity candles.
+
+Compares the per candle filter (a pytz conversion of every candle to check its hour, as the
+polygon adapter did before) against the session ranges of trading_calendar, on synthetic
+extended hours aggregates (4:00 to 20:00 ET) of 1, 5 and 21 sessions.
+
+    python benchmark_session_filter.py
+'''
+import datetime, time
+import pytz
+import trading_calendar
+
+_SESSION_COUNTS = [1, 5, 21]
+_REPEAT = 5
+_TIMEZONE_US_EAST = pytz.timezone('US/EASTERN')
+
+
+def _generate_ts(n_sessions):
+    sessions = trading_calendar.get_sessions(int(datetime.datetime(2021, 3, 1, tzinfo=pytz.utc).timestamp()), int(time.time()))[:n_sessions]
+    ts = []
+    for _, open_epoch_seconds, _ in sessions:
+        ts += list(range(open_epoch_seconds - 330 * 60, open_epoch_seconds + 630 * 60, 60))
+    return ts, sessions
+
+
+def _filter_per_candle(ts, sessions):
+    def epoch_seconds_to_et(timestamp_seconds):
+        t = datetime.datetime.utcfromtimestamp(timestamp_seconds)
+        return pytz.utc.localize(t).astimezone(_TIMEZONE_US_EAST)
+    return [t for t in ts if epoch_seconds_to_et(t).hour < 16]
+
+
+def _filter_session_ranges(ts, sessions):
+    ret = []
+    for _, open_epoch_seconds, close_epoch_seconds in sessions:
+        begin, end = trading_calendar.get_session_range(ts, open_epoch_seconds, close_epoch_seconds)
+        ret += ts[begin:end]
+    return ret
+
+
+def _timed(f, *args):
+    elapsed = []
+    for _ in range(_REPEAT):
+        start = time.perf_counter()
+        f(*args)
+        elapsed.append(time.perf_counter() - start)
+    return min(elapsed)
+
+
+def main():
+    for n in _SESSION_COUNTS:
+        ts, sessions = _generate_ts(n)
+        before = _timed(_filter_per_candle, ts, sessions)
+        after = _timed(_filter_session_ranges, ts, sessions)
+        print('{n:>3} sessions, {c:>6} candles: per candle {b:>8.2f} ms, session ranges {a:>6.3f} ms, kept {k} candles'.format(
+            n=n, c=len(ts), b=before * 1000, a=after * 1000, k=len(_filter_session_ranges(ts, sessions))))
+
+
+if __name__ == '__main__':
+    main()
@@ -6,5 +6,10 @@ cd package
 zip -r ../my-deployment-package.zip .
 cd ..
 zip -g my-deployment-package.zip lambda_function.py
+zip -g my-deployment-package.zip candle_store.py
+zip -g my-deployment-package.zip exchange_adapters.py
+zip -g my-deployment-package.zip trading_calendar.py
+zip -g my-deployment-package.zip resilience.py
+zip -g my-deployment-package.zip rate_limit.py
 aws s3 cp my-deployment-package.zip s3://market-price-history-lambda/
 aws lambda update-function-code --function-name MarketPriceHistory --s3-bucket market-price-history-lambda --s3-key my-deployment-package.zip
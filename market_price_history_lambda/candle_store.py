@@ -0,0 +1,257 @@
+'''
+Store of the finalized 1 minute candles, one blob per (market, symbol, utc day).
+
+A blob holds the columns t, o, h, l, c, v packed as little endian int64 and float64 arrays after a
+small json header, gzipped, and the range [covered_from, covered_until) of the day the candles
+were fetched for, so a minute without a candle within that range is known to have none.
+
+The backend is a local directory (PRICE_HISTORY_CANDLE_STORE=/tmp/candle_store, the default)
+or an s3 prefix (PRICE_HISTORY_CANDLE_STORE=s3://bucket/prefix). An empty value disables it.
+'''
+import array, asyncio, bisect, collections, datetime, gzip, json, os, struct, sys, threading, time, urllib.parse
+import boto3
+
+_STORE_URL = os.getenv('PRICE_HISTORY_CANDLE_STORE', '/tmp/candle_store')
+# candles younger than this may still change upstream, they are returned but not stored.
+_FINALIZE_DELAY_SECONDS = int(os.getenv('PRICE_HISTORY_CANDLE_FINALIZE_DELAY_SECONDS', '120'))
+_MEMORY_MAX_DAYS = int(os.getenv('PRICE_HISTORY_CANDLE_STORE_MEMORY_MAX_DAYS', '256'))
+_CANDLE_SECONDS = 60
+_DAY_SECONDS = 24 * 3600
+_COLUMNS = ['t', 'o', 'h', 'l', 'c', 'v']
+
+_store = None
+
+
+def _empty_columns():
+    return {k: [] for k in _COLUMNS}
+
+
+def _encode_day(covered_from, covered_until, columns):
+    header = json.dumps({'covered_from': covered_from, 'covered_until': covered_until, 'n': len(columns['t'])}).encode('utf-8')
+    arrays = [array.array('q', columns['t'])] + [array.array('d', columns[k]) for k in _COLUMNS[1:]]
+    if sys.byteorder == 'big':
+        for a in arrays:
+            a.byteswap()
+    return gzip.compress(struct.pack('<I', len(header)) + header + b''.join(a.tobytes() for a in arrays), compresslevel=6)
+
+
+def _decode_day(blob):
+    payload = gzip.decompress(blob)
+    header_length = struct.unpack_from('<I', payload)[0]
+    header = json.loads(payload[4:4 + header_length])
+    n = header['n']
+    offset = 4 + header_length
+    columns = {}
+    for k in _COLUMNS:
+        a = array.array('q' if k == 't' else 'd')
+        a.frombytes(payload[offset:offset + 8 * n])
+        if sys.byteorder == 'big':
+            a.byteswap()
+        columns[k] = a.tolist()
+        offset += 8 * n
+    return header['covered_from'], header['covered_until'], columns
+
+
+class LocalBackend:
+    def __init__(self, root):
+        self.root = root
+
+    def get(self, key):
+        try:
+            with open(os.path.join(self.root, key), 'rb') as f:
+                return f.read()
+        except FileNotFoundError:
+            return None
+
+    def put(self, key, blob):
+        path = os.path.join(self.root, key)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        # written aside and renamed so a concurrent reader never sees a partial blob.
+        tmp_path = '{p}.{pid}.{tid}.tmp'.format(p=path, pid=os.getpid(), tid=threading.get_ident())
+        with open(tmp_path, 'wb') as f:
+            f.write(blob)
+        os.replace(tmp_path, path)
+
+
+class S3Backend:
+    def __init__(self, bucket, prefix):
+        self.bucket = bucket
+        self.prefix = prefix.strip('/')
+        self.client = boto3.client('s3')
+
+    def _get_object_key(self, key):
+        return '{p}/{k}'.format(p=self.prefix, k=key) if self.prefix else key
+
+    def get(self, key):
+        try:
+            return self.client.get_object(Bucket=self.bucket, Key=self._get_object_key(key))['Body'].read()
+        except self.client.exceptions.NoSuchKey:
+            return None
+
+    def put(self, key, blob):
+        self.client.put_object(Bucket=self.bucket, Key=self._get_object_key(key), Body=blob)
+
+
+class CandleStore:
+    '''
+    Serves the candles of a market and symbol from the stored days, fetching only the tail that
+    is not stored yet, and stores the finalized candles of what it fetched.
+
+    The days read or written are also kept in memory by the warm container.
+    '''
+    def __init__(self, backend, memory_max_days=_MEMORY_MAX_DAYS):
+        self.backend = backend
+        self.memory_max_days = memory_max_days
+        self._days = collections.OrderedDict()
+        self._lock = threading.Lock()
+        self.stored_candles = 0
+        self.fetched_candles = 0
+
+    @staticmethod
+    def _get_key(market, symbol, day_start):
+        day_str = datetime.datetime.utcfromtimestamp(day_start).strftime('%Y-%m-%d')
+        return '{m}/{s}/{d}.candles.gz'.format(m=market, s=urllib.parse.quote(symbol, safe=''), d=day_str)
+
+    def _get_day(self, market, symbol, day_start):
+        '''
+        Returns (covered_from, covered_until, columns) of the day, or None if nothing is stored for it.
+        '''
+        key = self._get_key(market, symbol, day_start)
+        with self._lock:
+            if key in self._days:
+                self._days.move_to_end(key)
+                return self._days[key]
+        blob = self.backend.get(key)
+        if blob is None:
+            return None
+        day = _decode_day(blob)
+        self._remember(key, day)
+        return day
+
+    def _remember(self, key, day):
+        with self._lock:
+            self._days[key] = day
+            self._days.move_to_end(key)
+            while len(self._days) > self.memory_max_days:
+                self._days.popitem(last=False)
+
+    def _put_day(self, market, symbol, day_start, covered_from, covered_until, columns):
+        key = self._get_key(market, symbol, day_start)
+        self.backend.put(key, _encode_day(covered_from, covered_until, columns))
+        self._remember(key, (covered_from, covered_until, columns))
+
+    def _get_stored(self, market, symbol, from_epoch_seconds):
+        '''
+        Returns the stored candles from `from_epoch_seconds` on, as far as the stored days are
+        contiguous, and the epoch seconds the tail has to be fetched from.
+        '''
+        columns = _empty_columns()
+        start = from_epoch_seconds
+        while True:
+            day_start = start - start % _DAY_SECONDS
+            day = self._get_day(market, symbol, day_start)
+            if day is None:
+                break
+            covered_from, covered_until, day_columns = day
+            if not covered_from <= start < covered_until:
+                break
+            for i, t in enumerate(day_columns['t']):
+                if start <= t < covered_until:
+                    for k in _COLUMNS:
+                        columns[k].append(day_columns[k][i])
+            start = covered_until
+            if covered_until < day_start + _DAY_SECONDS:
+                break
+        return columns, start
+
+    def _store_fetched(self, market, symbol, fetched, complete_from, complete_until, finalized_until):
+        '''
+        Stores the finalized candles of `fetched` within [complete_from, complete_until), the range
+        it holds every candle of, up to its last candle, merged into the days already stored.
+        '''
+        ts = fetched['t']
+        start = complete_from
+        until = min(finalized_until, complete_until, ts[-1] + _CANDLE_SECONDS) if ts else start
+        if start >= until:
+            return
+        day_start = start - start % _DAY_SECONDS
+        i = bisect.bisect_left(ts, start)
+        while day_start < until:
+            day_end = day_start + _DAY_SECONDS
+            covered_from, covered_until = max(start, day_start), min(until, day_end)
+            if covered_from >= covered_until:
+                break
+            j = i
+            while j < len(ts) and ts[j] < covered_until:
+                j += 1
+            new_columns = {k: fetched[k][i:j] for k in _COLUMNS}
+            i = j
+            stored = self._get_day(market, symbol, day_start)
+            if stored is not None and stored[1] < covered_from:
+                # a gap after the stored candles, which the exchange may no longer serve, they are kept.
+                day_start = day_end
+                continue
+            if stored is not None and stored[0] <= covered_from <= stored[1]:
+                # the stored day runs up to where this fetch started, the fetch extends it.
+                stored_from, _, stored_columns = stored
+                keep = sum(1 for t in stored_columns['t'] if t < covered_from)
+                new_columns = {k: stored_columns[k][:keep] + new_columns[k] for k in _COLUMNS}
+                covered_from = stored_from
+            self._put_day(market, symbol, day_start, covered_from, covered_until, new_columns)
+            day_start = day_end
+
+    async def get_candles(self, market, symbol, from_epoch_seconds, fetch):
+        '''
+        Returns the columns of the candles from `from_epoch_seconds` on, and the epoch seconds
+        they are complete from, later than `from_epoch_seconds` when the exchange left the
+        beginning out.
+
+        `fetch(from_epoch_seconds)` is the coroutine getting the candles from the exchange along
+        with the range they are complete over, only that range is stored. It is awaited once for
+        the tail after the stored candles, and not at all for a range that is stored entirely.
+        The backend is read and written off the event loop.
+        '''
+        try:
+            columns, start = await asyncio.to_thread(self._get_stored, market, symbol, from_epoch_seconds)
+        except Exception as ex:
+            print('could not read the stored candles of {m} {s}:'.format(m=market, s=symbol), ex)
+            columns, start = _empty_columns(), from_epoch_seconds
+        now = int(time.time())
+        finalized_until = (now - _FINALIZE_DELAY_SECONDS) // _CANDLE_SECONDS * _CANDLE_SECONDS
+        stored_count = len(columns['t'])
+        complete_from = from_epoch_seconds
+        if start < now:
+            fetched, fetched_from, fetched_until = await fetch(start)
+            fetched_from = max(fetched_from, start)
+            keep = [i for i, t in enumerate(fetched['t']) if t >= start]
+            fetched = {k: [fetched[k][i] for i in keep] for k in _COLUMNS}
+            try:
+                await asyncio.to_thread(self._store_fetched, market, symbol, fetched, fetched_from, fetched_until, finalized_until)
+            except Exception as ex:
+                # the store only saves upstream calls, the response does not depend on it.
+                print('could not store the candles of {m} {s}:'.format(m=market, s=symbol), ex)
+            if fetched_from > start:
+                # the stored candles would be followed by a gap, only the fetched ones are returned.
+                columns = _empty_columns()
+                complete_from = fetched_from
+            for k in _COLUMNS:
+                columns[k] += fetched[k]
+            self.fetched_candles += len(fetched['t'])
+        self.stored_candles += stored_count
+        print('candle store: {s} stored candles, fetched from {f} for {m} {sym}'.format(
+            s=stored_count, f=start, m=market, sym=symbol))
+        return columns, complete_from
+
+
+def get_store():
+    '''
+    Returns the candle store configured by PRICE_HISTORY_CANDLE_STORE, None if it is disabled.
+    '''
+    global _store
+    if _store is None and _STORE_URL:
+        if _STORE_URL.startswith('s3://'):
+            bucket, _, prefix = _STORE_URL[len('s3://'):].partition('/')
+            _store = CandleStore(S3Backend(bucket, prefix))
+        else:
+            _store = CandleStore(LocalBackend(_STORE_URL))
+    return _store
@@ -0,0 +1,408 @@
+'''
+Registry of the exchange adapters fetching 1 minute candles, on one asyncio http session.
+
+An adapter turns the upstream payloads of its exchange into the columns t, o, h, l, c, v.
+Adding a market is adding an Adapter subclass decorated with @register('<market>').
+
+The event loop and the session are kept by the warm container, so the connections to the
+exchanges are pooled across invocations. Several fetches run concurrently on that loop:
+
+    columns, complete_from, complete_until = run(get_adapter('binance').fetch('BTCUSDT', from_epoch_seconds))
+'''
+import asyncio, bisect, datetime, os, time
+import aiohttp
+import rate_limit, resilience, trading_calendar
+
+_API_KEY_POLYGON = os.getenv('API_KEY_POLYGON', '')
+_BINANCE_BASE_URL = 'https://api.binance.com/api/v3'
+_POLYGON_BASE_URL = 'https://api.polygon.io/v2'
+_OKCOIN_BASE_URL = 'https://www.okcoin.com/api'
+_KRAKEN_BASE_URL = 'https://api.kraken.com/0/public'
+
+_DATETIME_FORMAT_QUERY = '%Y-%m-%dT%H:%M:%S.000Z'
+_DATETIME_FORMAT_CANDLE_HISTORY = '%Y-%m-%dT%H:%M:%S.000%z'
+
+_REQUEST_TIMEOUT_SECONDS = float(os.getenv('PRICE_HISTORY_REQUEST_TIMEOUT_SECONDS', '10'))
+_CONNECT_TIMEOUT_SECONDS = float(os.getenv('PRICE_HISTORY_CONNECT_TIMEOUT_SECONDS', '3'))
+_MAX_CONNECTIONS_PER_HOST = int(os.getenv('PRICE_HISTORY_MAX_CONNECTIONS_PER_HOST', '8'))
+
+_BINANCE_PAGE_CANDLES = 1000
+_BINANCE_MAX_PAGES = 50
+_POLYGON_MAX_SESSIONS = int(os.getenv('PRICE_HISTORY_POLYGON_MAX_SESSIONS', '31'))
+_OKCOIN_PAGE_CANDLES = int(os.getenv('PRICE_HISTORY_OKCOIN_PAGE_CANDLES', '300'))
+# at the 8 requests per second of the okcoin bucket, about 6 seconds of requests.
+_OKCOIN_MAX_PAGES = int(os.getenv('PRICE_HISTORY_OKCOIN_MAX_PAGES', '48'))
+_KRAKEN_MAX_CANDLES = 720
+_KRAKEN_MAX_PAGES = 10
+# request weight of the klines of up to 1000 candles.
+_BINANCE_KLINES_WEIGHT = 2
+
+_COLUMNS = ['t', 'o', 'h', 'l', 'c', 'v']
+_MINUTE_SECONDS = 60
+INTERVAL_SECONDS = {
+    '1m': 60, '5m': 5 * 60, '15m': 15 * 60, '30m': 30 * 60,
+    '1h': 3600, '4h': 4 * 3600, '1d': 24 * 3600,
+}
+
+_loop = None
+_session = None
+_adapters = {}
+
+
+class UpstreamError(Exception):
+    pass
+
+
+def get_event_loop():
+    global _loop
+    if _loop is None or _loop.is_closed():
+        _loop = asyncio.new_event_loop()
+    return _loop
+
+
+def run(coroutine):
+    '''
+    Runs the coroutine to completion on the event loop kept by the warm container.
+    '''
+    return get_event_loop().run_until_complete(coroutine)
+
+
+def get_session():
+    '''
+    Returns the http session of the event loop, to be called from a coroutine running on it.
+    '''
+    global _session
+    if _session is None or _session.closed:
+        _session = aiohttp.ClientSession(
+            connector=aiohttp.TCPConnector(limit_per_host=_MAX_CONNECTIONS_PER_HOST, ttl_dns_cache=300),
+            timeout=aiohttp.ClientTimeout(total=_REQUEST_TIMEOUT_SECONDS, connect=_CONNECT_TIMEOUT_SECONDS),
+        )
+    return _session
+
+
+def empty_columns():
+    return {k: [] for k in _COLUMNS}
+
+
+def _to_columns(candles, t, o, h, l, c, v):
+    '''
+    Returns the columns of the upstream `candles`, `t` returning the epoch seconds of a candle
+    and o, h, l, c, v the indexes (or keys) of its prices and volume.
+    '''
+    return {
+        't': [t(p) for p in candles],
+        'o': [float(p[o]) for p in candles],
+        'h': [float(p[h]) for p in candles],
+        'l': [float(p[l]) for p in candles],
+        'c': [float(p[c]) for p in candles],
+        'v': [float(p[v]) for p in candles],
+    }
+
+
+def merge_pages(pages):
+    '''
+    Returns the columns of the candles of the `pages` sorted on t, a candle found in more than one page is kept once.
+    '''
+    candles = {}
+    for columns in pages:
+        for i, t in enumerate(columns['t']):
+            candles[t] = (columns, i)
+    ts = sorted(candles)
+    return {k: [candles[t][0][k][candles[t][1]] for t in ts] for k in _COLUMNS}
+
+
+def concat_pages(pages):
+    '''
+    Returns the columns of the `pages` one after another, for pages of disjoint ranges in order.
+    '''
+    return {k: [x for columns in pages for x in columns[k]] for k in _COLUMNS}
+
+
+def complete_pages(from_epoch_seconds, windows, pages):
+    '''
+    Returns the `pages` fetched for the [start, end) `windows` with the failed ones (None) left
+    empty, and the [from, until) range they hold every candle of: from `from_epoch_seconds` up to
+    the start of the first failed window, or the end of the last one.
+
+    Raises UpstreamError if every page failed, as there is nothing to answer with.
+    '''
+    if pages and all(page is None for page in pages):
+        raise UpstreamError('none of the {n} pages could be fetched.'.format(n=len(pages)))
+    complete_until = windows[-1][1] if windows else from_epoch_seconds
+    for (start, _), page in zip(windows, pages):
+        if page is None:
+            complete_until = start
+            break
+    return [page if page is not None else empty_columns() for page in pages], from_epoch_seconds, complete_until
+
+
+def plan_windows(from_epoch_seconds, to_epoch_seconds, window_seconds):
+    '''
+    Returns the [start, end) epoch seconds of the windows of `window_seconds` covering the range.
+    '''
+    return [(start, min(start + window_seconds, to_epoch_seconds)) for start in range(from_epoch_seconds, to_epoch_seconds, window_seconds)]
+
+
+def resample(columns, interval_seconds):
+    '''
+    Returns the candles of the sorted `columns` bucketed into `interval_seconds` candles aligned on
+    the epoch: the first open, the highest high, the lowest low, the last close and the total volume.
+    '''
+    ts = columns['t']
+    ret = empty_columns()
+    i = 0
+    while i < len(ts):
+        bucket = ts[i] - ts[i] % interval_seconds
+        j = bisect.bisect_left(ts, bucket + interval_seconds, i)
+        ret['t'].append(bucket)
+        ret['o'].append(columns['o'][i])
+        ret['h'].append(max(columns['h'][i:j]))
+        ret['l'].append(min(columns['l'][i:j]))
+        ret['c'].append(columns['c'][j - 1])
+        ret['v'].append(sum(columns['v'][i:j]))
+        i = j
+    return ret
+
+
+def _to_query_datetime(epoch_seconds):
+    return datetime.datetime.fromtimestamp(epoch_seconds, tz=datetime.timezone.utc).strftime(_DATETIME_FORMAT_QUERY)
+
+
+class Adapter:
+    '''
+    Fetches the candles of an exchange.
+
+    `fetch` returns the columns of the candles from `from_epoch_seconds` up to now, and the
+    [complete_from, complete_until) range they hold every candle of, which a failed page or an
+    exchange that no longer serves the older candles leaves short. `decode` returns the columns
+    of a single upstream payload. The intervals of `native_intervals` (seconds to
+    the parameter of the exchange) are requested from the exchange as they are, the others
+    are resampled from the 1 minute candles.
+    '''
+    name = None
+    native_intervals = {_MINUTE_SECONDS: None}
+
+    async def get_json(self, url, params=None, weight=1):
+        '''
+        Returns the decoded json of the url, None if the exchange answers with an error status,
+        times out, cannot be reached or answers with something else than json, which the
+        callers take as a failed page.
+
+        The request waits for `weight` tokens of the rate limit of its host, then goes through
+        resilience for its per host timeout, hedging and circuit breaker, whose CircuitOpenError
+        while the exchange is failing is a failed page as well.
+        '''
+        bucket = rate_limit.get_bucket(url)
+        attempts = []
+
+        async def send(timeout_seconds):
+            # the first attempt waited for its tokens, a hedged duplicate is charged without waiting.
+            if attempts:
+                bucket.reserve(weight)
+            attempts.append(timeout_seconds)
+            timeout = aiohttp.ClientTimeout(total=timeout_seconds, connect=_CONNECT_TIMEOUT_SECONDS)
+            async with get_session().get(url, params=params, timeout=timeout) as r:
+                bucket.on_response(r.status, r.headers)
+                if r.status >= 400:
+                    # the path only, the query holds the api key of polygon.
+                    return r.status, '{p}: {t}'.format(p=r.url.path, t=await r.text())
+                return r.status, await r.json(content_type=None)
+
+        # waited out of the timeout of the request.
+        await bucket.acquire_async(weight)
+        try:
+            status, payload = await resilience.get_async(url, send)
+        except (asyncio.TimeoutError, aiohttp.ClientError, resilience.CircuitOpenError, ValueError) as ex:
+            # the message of a ClientResponseError holds the url, query and polygon api key included.
+            message = ex.message if isinstance(ex, aiohttp.ClientResponseError) else ex
+            print('{n} could not get {u}: {t} {m}'.format(n=self.name, u=url, t=type(ex).__name__, m=message))
+            return None
+        if status >= 400:
+            print('{n} answered {s} for {p}'.format(n=self.name, s=status, p=payload))
+            return None
+        return payload
+
+    def decode(self, payload):
+        raise NotImplementedError
+
+    async def fetch_native(self, symbol, from_epoch_seconds, interval_seconds):
+        raise NotImplementedError
+
+    async def fetch(self, symbol, from_epoch_seconds, interval_seconds=_MINUTE_SECONDS):
+        if interval_seconds in self.native_intervals:
+            return await self.fetch_native(symbol, from_epoch_seconds, interval_seconds)
+        columns, complete_from, complete_until = await self.fetch_native(symbol, from_epoch_seconds, _MINUTE_SECONDS)
+        return resample(columns, interval_seconds), complete_from, complete_until
+
+
+def register(*markets):
+    '''
+    Registers the decorated Adapter subclass for the `markets`.
+    '''
+    def decorator(cls):
+        adapter = cls()
+        for market in markets:
+            _adapters[market] = adapter
+        return cls
+    return decorator
+
+
+def get_adapter(market):
+    return _adapters.get(market)
+
+
+def get_markets():
+    return sorted(_adapters.keys())
+
+
+@register('binance')
+class BinanceAdapter(Adapter):
+    '''
+    binance returns at most _BINANCE_PAGE_CANDLES klines per request, the range is split into
+    windows of that many candles which are fetched concurrently, paced by the weight budget of
+    rate_limit, and put back together in order. Only the most recent _BINANCE_MAX_PAGES windows
+    are fetched, the complete range then starts at the first of them.
+    '''
+    name = 'binance'
+    native_intervals = {60: '1m', 300: '5m', 900: '15m', 1800: '30m', 3600: '1h', 14400: '4h', 86400: '1d'}
+
+    def decode(self, payload):
+        return _to_columns(payload, lambda p: p[0] // 1000, 1, 2, 3, 4, 5)
+
+    async def _fetch_window(self, symbol, start_epoch_seconds, end_epoch_seconds, interval_seconds):
+        klines = await self.get_json(_BINANCE_BASE_URL + '/klines', params={
+            'symbol': symbol, 'interval': self.native_intervals[interval_seconds],
+            'startTime': start_epoch_seconds * 1000, 'endTime': end_epoch_seconds * 1000 - 1, 'limit': _BINANCE_PAGE_CANDLES},
+            weight=_BINANCE_KLINES_WEIGHT)
+        return None if klines is None else self.decode(klines)
+
+    async def fetch_native(self, symbol, from_epoch_seconds, interval_seconds):
+        windows = plan_windows(from_epoch_seconds, int(time.time()), _BINANCE_PAGE_CANDLES * interval_seconds)
+        if len(windows) > _BINANCE_MAX_PAGES:
+            print('fetching the last {n} of the {m} windows of {s} from {f}.'.format(
+                n=_BINANCE_MAX_PAGES, m=len(windows), s=symbol, f=from_epoch_seconds))
+            windows = windows[-_BINANCE_MAX_PAGES:]
+            from_epoch_seconds = windows[0][0]
+        pages, complete_from, complete_until = complete_pages(from_epoch_seconds, windows, await asyncio.gather(*[
+            self._fetch_window(symbol, start, end, interval_seconds) for start, end in windows]))
+        return concat_pages(pages), complete_from, complete_until
+
+
+@register('stock', 'polygon')
+class PolygonAdapter(Adapter):
+    '''
+    Fetches the aggregates of each regular session from `from` on concurrently, the most recent
+    _POLYGON_MAX_SESSIONS of them, and keeps the candles within the open and close of the session.
+    '''
+    name = 'polygon'
+
+    def decode(self, payload):
+        return _to_columns(payload.get('results') or [], lambda p: p['t'] // 1000, 'o', 'h', 'l', 'c', 'v')
+
+    async def _fetch_session(self, symbol, day, open_epoch_seconds, close_epoch_seconds):
+        date_str = day.strftime('%Y-%m-%d')
+        js = await self.get_json(_POLYGON_BASE_URL + '/aggs/ticker/{s}/range/1/minute/{d}/{d}'.format(s=symbol, d=date_str), params={
+            'unadjusted': 'false', 'sort': 'asc', 'limit': 50000, 'apiKey': _API_KEY_POLYGON})
+        if js is None:
+            return None
+        columns = self.decode(js)
+        begin, end = trading_calendar.get_session_range(columns['t'], open_epoch_seconds, close_epoch_seconds)
+        return {k: columns[k][begin:end] for k in _COLUMNS}
+
+    async def fetch_native(self, symbol, from_epoch_seconds, interval_seconds):
+        sessions = trading_calendar.get_sessions(from_epoch_seconds, int(time.time()))
+        if len(sessions) > _POLYGON_MAX_SESSIONS:
+            print('fetching the last {n} of the {m} sessions of {s} from {f}.'.format(
+                n=_POLYGON_MAX_SESSIONS, m=len(sessions), s=symbol, f=from_epoch_seconds))
+            sessions = sessions[-_POLYGON_MAX_SESSIONS:]
+            from_epoch_seconds = sessions[0][1]
+        windows = [(max(open_epoch_seconds, from_epoch_seconds), close_epoch_seconds) for _, open_epoch_seconds, close_epoch_seconds in sessions]
+        pages, complete_from, complete_until = complete_pages(from_epoch_seconds, windows, await asyncio.gather(*[
+            self._fetch_session(symbol, day, start, end) for (day, _, _), (start, end) in zip(sessions, windows)]))
+        return merge_pages(pages), complete_from, complete_until
+
+
+@register('okcoin')
+class OkcoinAdapter(Adapter):
+    '''
+    okcoin returns at most _OKCOIN_PAGE_CANDLES candles per request, the range is split into
+    pages of that many candles which are fetched concurrently, the most recent _OKCOIN_MAX_PAGES
+    of them.
+    '''
+    name = 'okcoin'
+    native_intervals = {s: s for s in [60, 300, 900, 1800, 3600, 14400, 86400]}
+
+    def decode(self, payload):
+        return _to_columns(payload[::-1], lambda p: int(datetime.datetime.strptime(p[0], _DATETIME_FORMAT_CANDLE_HISTORY).timestamp()), 1, 2, 3, 4, 5)
+
+    async def _fetch_page(self, symbol, start_epoch_seconds, end_epoch_seconds, interval_seconds):
+        js = await self.get_json(_OKCOIN_BASE_URL + '/spot/v3/instruments/{pair}/candles'.format(pair=symbol), params={
+            'granularity': self.native_intervals[interval_seconds], 'start': _to_query_datetime(start_epoch_seconds), 'end': _to_query_datetime(end_epoch_seconds)})
+        return None if js is None else self.decode(js)
+
+    async def fetch_native(self, symbol, from_epoch_seconds, interval_seconds):
+        windows = plan_windows(from_epoch_seconds, int(time.time()), _OKCOIN_PAGE_CANDLES * interval_seconds)
+        if len(windows) > _OKCOIN_MAX_PAGES:
+            print('fetching the last {n} of the {m} pages of {s} from {f}.'.format(
+                n=_OKCOIN_MAX_PAGES, m=len(windows), s=symbol, f=from_epoch_seconds))
+            windows = windows[-_OKCOIN_MAX_PAGES:]
+            from_epoch_seconds = windows[0][0]
+        pages, complete_from, complete_until = complete_pages(from_epoch_seconds, windows, await asyncio.gather(*[
+            self._fetch_page(symbol, start, end, interval_seconds) for start, end in windows]))
+        return merge_pages(pages), complete_from, complete_until
+
+
+@register('kraken')
+class KrakenAdapter(Adapter):
+    '''
+    kraken answers with up to its most recent _KRAKEN_MAX_CANDLES candles of an interval in one
+    request, so a single request runs up to now. The `last` cursor is only followed when a page
+    came back capped before now.
+
+    A `from` older than those candles comes back starting later, which is logged.
+    '''
+    name = 'kraken'
+    native_intervals = {60: 1, 300: 5, 900: 15, 1800: 30, 3600: 60, 14400: 240, 86400: 1440}
+
+    def decode(self, payload):
+        return _to_columns(payload, lambda p: p[0], 1, 2, 3, 4, 6)
+
+    async def _fetch_page(self, symbol, since, interval_seconds):
+        js = await self.get_json(_KRAKEN_BASE_URL + '/OHLC', params={
+            'pair': symbol, 'since': since, 'interval': self.native_intervals[interval_seconds]})
+        if js is None:
+            return None, None
+        if js['error']:
+            print('could not get the kraken candles of {s}:'.format(s=symbol), js['error'])
+            return None, None
+
+        # the result is keyed by kraken's own name of the pair, next to the cursor.
+        candles = [v for k, v in js['result'].items() if k != 'last']
+        if not candles:
+            return None, None
+        return self.decode(candles[0]), js['result'].get('last')
+
+    async def fetch_native(self, symbol, from_epoch_seconds, interval_seconds):
+        now = int(time.time())
+        pages = []
+        since = from_epoch_seconds
+        complete_from, complete_until = from_epoch_seconds, from_epoch_seconds
+        for _ in range(_KRAKEN_MAX_PAGES):
+            columns, last = await self._fetch_page(symbol, since, interval_seconds)
+            if columns is None:
+                if not pages:
+                    raise UpstreamError('the candles of {s} could not be fetched.'.format(s=symbol))
+                break
+            pages.append(columns)
+            capped_before_now = len(columns['t']) >= _KRAKEN_MAX_CANDLES and columns['t'][-1] + interval_seconds <= now
+            complete_until = columns['t'][-1] + interval_seconds if capped_before_now else now
+            if not capped_before_now or last is None or int(last) <= since:
+                break
+            since = int(last)
+        ret = merge_pages(pages)
+        if ret['t'] and ret['t'][0] > from_epoch_seconds + interval_seconds:
+            print('kraken returned the candles of {s} from {t} on, later than the requested {f}, it keeps only the most recent {n} candles.'.format(
+                s=symbol, t=ret['t'][0], f=from_epoch_seconds, n=_KRAKEN_MAX_CANDLES))
+            # the candles before the first one returned are unknown rather than absent.
+            complete_from = ret['t'][0]
+        return ret, complete_from, complete_until
@@ -1,30 +1,49 @@
-import datetime, decimal, json, requests
+import asyncio, base64, datetime, decimal, gzip, hashlib, json
 import os
-import pytz
-from binance.client import Client as BinanceClient
-from polygon import RESTClient as PolygonClient
+import candle_store, exchange_adapters, rate_limit
+try:
+    import brotli
+except ImportError:
+    brotli = None
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
 
 
-_TIMEZONE_US_EAST = pytz.timezone('US/EASTERN')
 _DATETIME_FORMAT = '%Y-%m-%dT%H:%M:%S%z'
-_API_KEY = os.getenv('API_KEY_BINANCE')
-_API_SECRET = os.getenv('API_SECRET_BINANCE')
-_API_KEY_POLYGON = os.getenv('API_KEY_POLYGON')
-_OKCOIN_BASE_URL = 'https://www.okcoin.com/api'
-_KRAKEN_BASE_URL = 'https://api.kraken.com/0/public'
 
-_DATETIME_FORMAT_QUERY = '%Y-%m-%dT%H:%M:%S.000Z'
-_DATETIME_FORMAT_CANDLE_HISTORY = '%Y-%m-%dT%H:%M:%S.000%z'
+# bodies shorter than this are not worth the cpu, they fit in a few packets anyway.
+_COMPRESS_MIN_BYTES = int(os.getenv('PRICE_HISTORY_COMPRESS_MIN_BYTES', '1400'))
+_GZIP_LEVEL = int(os.getenv('PRICE_HISTORY_GZIP_LEVEL', '6'))
+_BROTLI_QUALITY = int(os.getenv('PRICE_HISTORY_BROTLI_QUALITY', '5'))
 
-_binance_client = None
-_polygon_client = None
+_CANDLE_COLUMNS = ['t', 'o', 'h', 'l', 'c', 'v']
+_FORMAT_ROWS = 'rows'
+_FORMAT_COLUMNAR = 'columnar'
+_FORMATS = [_FORMAT_ROWS, _FORMAT_COLUMNAR]
+_CONTENT_TYPE_JSON = 'application/json'
+_CONTENT_TYPES_MSGPACK = ['application/msgpack', 'application/x-msgpack']
 
 _EVENT_KEY_PATH_PARAMETER = 'pathParameters'
 _PATH_PARAMETER_MARKET = 'market'
 _PATH_PARAMETER_SYMBOL = 'symbol'
 
 _EVENT_KEY_QUERY_STRING_PARAMETER = 'queryStringParameters'
+_EVENT_KEY_HEADERS = 'headers'
+_HEADER_KEY_ETAG = 'ETag'
+_HEADER_KEY_IF_NONE_MATCH = 'If-None-Match'
+_HEADER_KEY_ACCEPT_ENCODING = 'Accept-Encoding'
+_HEADER_KEY_ACCEPT = 'Accept'
+_HEADER_KEY_TRUNCATED_FROM = 'X-Price-History-Truncated-From'
 _PARAM_KEY_FROM = 'from'
+_PARAM_KEY_FORMAT = 'format'
+_PARAM_KEY_INTERVAL = 'interval'
+_PARAM_KEY_SYMBOLS = 'symbols'
+_MAX_BATCH_SYMBOLS = int(os.getenv('PRICE_HISTORY_MAX_BATCH_SYMBOLS', '50'))
+# the rate limiters of the adapters pace the requests, this bounds the series held at once.
+_BATCH_MAX_CONCURRENCY = int(os.getenv('PRICE_HISTORY_BATCH_MAX_CONCURRENCY', '8'))
+_MINUTE_SECONDS = 60
 
 _RESPONSE_400 = {
         'statusCode': 400,
@@ -36,6 +55,16 @@ _RESPONSE_400 = {
     }
 
 
+_RESPONSE_503 = {
+        'statusCode': 503,
+        'headers': {
+            'Access-Control-Allow-Headers': 'Content-Type',
+            'Access-Control-Allow-Origin': '*',
+            'Access-Control-Allow-Methods': 'OPTIONS,POST,GET'
+        }
+    }
+
+
 class DecimalEncoder(json.JSONEncoder):
     def default(self, obj):
         if isinstance(obj, decimal.Decimal):
@@ -46,89 +75,152 @@ class DecimalEncoder(json.JSONEncoder):
         return json.JSONEncoder.default(self, obj)
 
 
-def get_binance_client():
-    global _binance_client
-    if _binance_client is None:
-        _binance_client = BinanceClient(_API_KEY, _API_SECRET)
-    return _binance_client
-
-def get_polygon_client():
-    global _polygon_client
-    if _polygon_client is None:
-        _polygon_client = PolygonClient(_API_KEY_POLYGON)
-    return _polygon_client
-
-
-def _get_equity_minutely_ohlcv(symbol, from_epoch_seconds):
-    def epoch_seconds_to_et(timestamp_seconds):
-        t = datetime.datetime.utcfromtimestamp(timestamp_seconds)
-        t_utc = pytz.utc.localize(t)
-        t_tz = t_utc.astimezone(_TIMEZONE_US_EAST)
-        return t_tz
-
-    def epoch_seconds_to_et_str(timestamp_seconds):
-        t_tz = epoch_seconds_to_et(timestamp_seconds)
-        return t_tz.strftime('%Y-%m-%d')
-
-    date_str = epoch_seconds_to_et_str(from_epoch_seconds)
-    print('_get_equity_minutely_ohlcv', 'date_str', date_str)
-    candles_polygon = get_polygon_client().stocks_equities_aggregates(symbol, 1, "minute", date_str, date_str, unadjusted=False)
-    r = [{'o': p['o'], 'h': p['h'], 'l': p['l'], 'c': p['c'], 'v': p['v'], 't': p['t'] // 1000} for p in candles_polygon.results]
-    r = [p for p in r if p['t'] >= from_epoch_seconds]
-    r = [p for p in r if epoch_seconds_to_et(p['t']).hour < 16] # market close at 4pm et.
-    return r
-
-def _get_binance_minutely_ohlcv(symbol, from_epoch_seconds):
-    candles_binance = get_binance_client().get_historical_klines(symbol, BinanceClient.KLINE_INTERVAL_1MINUTE, from_epoch_seconds * 1000)
-    r = [{'o': float(p[1]), 'h': float(p[2]), 'l': float(p[3]), 'c': float(p[4]), 'v': float(p[5]), 't': p[0] // 1000} for p in candles_binance]
-    return r
-
-def _get_okcoin_minutely_ohlcv(symbol, from_epoch_seconds):
-    start = datetime.datetime.fromtimestamp(from_epoch_seconds, tz=datetime.timezone.utc).strftime(_DATETIME_FORMAT_QUERY)
-    now = datetime.datetime.now(tz=datetime.timezone.utc)
-    end = now.strftime(_DATETIME_FORMAT_QUERY)
-
-    url = _OKCOIN_BASE_URL + '/spot/v3/instruments/{pair}/candles?granularity=60&start={start}&end={end}'.format(
-        pair=symbol, start=start, end=end
-    )
-    print(url)
-    r = requests.get(url)
-    if not r.ok:
-        return []
-
-    js = r.json()
-    ret = []
-    for blob in js[::-1]:
-        t = datetime.datetime.strptime(blob[0], _DATETIME_FORMAT_CANDLE_HISTORY)
-        ret.append({'t': int(t.timestamp()), 'o': float(blob[1]), 'h': float(blob[2]), 'l': float(blob[3]), 'c': float(blob[4]), 'v': float(blob[5])})
+def _columns_to_rows(columns):
+    '''
+    Returns the candles as a list of {t, o, h, l, c, v} dicts, the default format of the response.
+    '''
+    return [dict(zip(_CANDLE_COLUMNS, candle)) for candle in zip(*(columns[k] for k in _CANDLE_COLUMNS))]
+
+
+async def _get_ohlcv(adapter, market, symbol, from_epoch_seconds, interval_seconds):
+    '''
+    Returns the columns of the candles from `from_epoch_seconds` on, and the epoch seconds they
+    are complete from, later than `from_epoch_seconds` when the range was too long to fetch whole.
+
+    The 1 minute candles come from the candle store with only the missing tail fetched from
+    the exchange, so do the coarser ones the exchange does not serve and are resampled from them.
+    '''
+    if interval_seconds in adapter.native_intervals and interval_seconds != _MINUTE_SECONDS:
+        columns, complete_from, _ = await adapter.fetch(symbol, from_epoch_seconds, interval_seconds)
+        return columns, complete_from
+    store = candle_store.get_store()
+    if store is None:
+        columns, complete_from, _ = await adapter.fetch(symbol, from_epoch_seconds)
+    else:
+        columns, complete_from = await store.get_candles(market, symbol, from_epoch_seconds, lambda f: adapter.fetch(symbol, f))
+    if interval_seconds != _MINUTE_SECONDS:
+        columns = exchange_adapters.resample(columns, interval_seconds)
+    return columns, complete_from
+
+
+async def _get_batch_ohlcv(adapter, market, symbols, from_epoch_seconds, interval_seconds):
+    '''
+    Returns the columns of each of the `symbols`, fetched concurrently, the errors of the
+    symbols that failed, which leave the others be, and the epoch seconds the truncated series
+    are complete from.
+    '''
+    semaphore = asyncio.Semaphore(_BATCH_MAX_CONCURRENCY)
+
+    async def get_ohlcv(symbol):
+        async with semaphore:
+            return await _get_ohlcv(adapter, market, symbol, from_epoch_seconds, interval_seconds)
+
+    results = await asyncio.gather(*[get_ohlcv(symbol) for symbol in symbols], return_exceptions=True)
+    series, errors, truncated = {}, {}, {}
+    for symbol, result in zip(symbols, results):
+        if isinstance(result, Exception):
+            print('could not get the candles of {m} {s}:'.format(m=market, s=symbol), repr(result))
+            errors[symbol] = '{t}: {e}'.format(t=type(result).__name__, e=result)
+            continue
+        series[symbol], complete_from = result
+        if complete_from > from_epoch_seconds:
+            truncated[symbol] = complete_from
+    return series, errors, truncated
+
+
+def _get_header(event, name):
+    headers = event.get(_EVENT_KEY_HEADERS) or {}
+    for k, v in headers.items():
+        if k.lower() == name.lower():
+            return v
+    return None
+
+
+def _with_etag(event, response):
+    '''
+    Sets the ETag of the response from a hash of its body, and answers 304 without the body
+    when the If-None-Match of the request already has it.
+    '''
+    etag = '"{h}"'.format(h=hashlib.sha1(response['body'].encode('utf-8')).hexdigest())
+    response['headers'][_HEADER_KEY_ETAG] = etag
+    if_none_match = _get_header(event, _HEADER_KEY_IF_NONE_MATCH)
+    if if_none_match:
+        etags = [t.strip().replace('W/', '', 1) for t in if_none_match.split(',')]
+        if etag in etags or '*' in etags:
+            return {'statusCode': 304, 'headers': response['headers']}
+    return response
+
+
+def _get_accepted_encodings(event):
+    '''
+    Returns the encodings of the Accept-Encoding of the request, leaving out the ones with q=0.
+    '''
+    accept_encoding = _get_header(event, _HEADER_KEY_ACCEPT_ENCODING) or ''
+    ret = set()
+    for token in accept_encoding.split(','):
+        encoding, _, params = token.partition(';')
+        q = params.strip().replace(' ', '')
+        try:
+            if q.startswith('q=') and float(q[2:]) == 0:
+                continue
+        except ValueError:
+            continue
+        if encoding.strip():
+            ret.add(encoding.strip().lower())
     return ret
 
-def _get_kraken_minutely_ohlcv(symbol, from_epoch_seconds):
-    url = _KRAKEN_BASE_URL + '/OHLC?pair={pair}&since={since}'.format(
-        pair=symbol, since=from_epoch_seconds
-    )
-    print(url)
-    r = requests.get(url)
-    if not r.ok:
-        return []
-
-    js = r.json()
-    ret = []
-    if js['error']:
-        return ret
-
-    symbol_key = symbol
-    for k, _ in js['result'].items():
-        if k == 'last': continue
-        symbol_key = k
-
-    if symbol_key not in js['result']:
-        return ret
-
-    print(js)
-    for blob in js['result'][symbol_key]:
-        ret.append({'t': blob[0], 'o': float(blob[1]), 'h': float(blob[2]), 'l': float(blob[3]), 'c': float(blob[4]), 'v': float(blob[6])})
-    return ret
+
+def _with_encoding(event, response):
+    '''
+    Compresses the body with brotli or gzip when it is at least _COMPRESS_MIN_BYTES long and the
+    client accepts it, returning it base64 encoded as the API Gateway proxy response expects.
+
+    The ETag is made weak as the compressed body is the same content in another encoding.
+    '''
+    if 'body' not in response:
+        return response
+    if response.get('isBase64Encoded'):
+        body = base64.b64decode(response['body'])
+    else:
+        body = response['body'].encode('utf-8')
+    if len(body) < _COMPRESS_MIN_BYTES:
+        return response
+    response['headers']['Vary'] = ','.join([_HEADER_KEY_ACCEPT, _HEADER_KEY_ACCEPT_ENCODING])
+    accepted = _get_accepted_encodings(event)
+    if brotli is not None and 'br' in accepted:
+        encoding = 'br'
+        body = brotli.compress(body, quality=_BROTLI_QUALITY)
+    elif 'gzip' in accepted or '*' in accepted:
+        encoding = 'gzip'
+        body = gzip.compress(body, compresslevel=_GZIP_LEVEL)
+    else:
+        return response
+
+    response['headers']['Content-Encoding'] = encoding
+    if _HEADER_KEY_ETAG in response['headers'] and not response['headers'][_HEADER_KEY_ETAG].startswith('W/'):
+        response['headers'][_HEADER_KEY_ETAG] = 'W/' + response['headers'][_HEADER_KEY_ETAG]
+    response['body'] = base64.b64encode(body).decode('ascii')
+    response['isBase64Encoded'] = True
+    return response
+
+
+def _accepts_msgpack(event):
+    accept = (_get_header(event, _HEADER_KEY_ACCEPT) or '').lower()
+    return msgpack is not None and any(t in accept for t in _CONTENT_TYPES_MSGPACK)
+
+
+def _format_series(columns, response_format):
+    return columns if response_format == _FORMAT_COLUMNAR else _columns_to_rows(columns)
+
+
+def _get_body(event, result):
+    '''
+    Returns the body of the result, as MessagePack when the Accept of the request asks for it,
+    else as json, with its content type and whether it is base64 encoded.
+    '''
+    if _accepts_msgpack(event):
+        return base64.b64encode(msgpack.packb(result)).decode('ascii'), _CONTENT_TYPES_MSGPACK[0], True
+    return json.dumps(result, cls=DecimalEncoder), _CONTENT_TYPE_JSON, False
 
 def lambda_handler(event, context):
     path_parameters = event[_EVENT_KEY_PATH_PARAMETER]
@@ -138,44 +230,95 @@ def lambda_handler(event, context):
         res['body'] = json.dumps('market is not specified.')
         return res
 
-    if _PATH_PARAMETER_SYMBOL not in path_parameters:
+    query_string_parameters = event[_EVENT_KEY_QUERY_STRING_PARAMETER]
+
+    # symbols=A,B,C asks for a batch, returned as {'series': {symbol: candles}, 'errors': {symbol: error},
+    # 'truncated': {symbol: epoch seconds the candles start from when the range was too long}}.
+    symbols = list(dict.fromkeys(s for s in (query_string_parameters.get(_PARAM_KEY_SYMBOLS) or '').split(',') if s))
+    if _PATH_PARAMETER_SYMBOL not in path_parameters and not symbols:
         res = _RESPONSE_400
         res['body'] = json.dumps('symbol is not specified.')
         return res
+    if len(symbols) > _MAX_BATCH_SYMBOLS:
+        res = _RESPONSE_400
+        res['body'] = json.dumps('at most {n} symbols can be asked at once.'.format(n=_MAX_BATCH_SYMBOLS))
+        return res
     market = path_parameters[_PATH_PARAMETER_MARKET]
-    symbol = path_parameters[_PATH_PARAMETER_SYMBOL]
-    
-    query_string_parameters = event[_EVENT_KEY_QUERY_STRING_PARAMETER]
+    symbol = path_parameters.get(_PATH_PARAMETER_SYMBOL)
 
     if _PARAM_KEY_FROM not in query_string_parameters:
         res = _RESPONSE_400
         res['body'] = json.dumps('{k} is not found.'.format(k=_PARAM_KEY_FROM))
         return res
     
+    response_format = query_string_parameters.get(_PARAM_KEY_FORMAT, _FORMAT_ROWS)
+    if response_format not in _FORMATS:
+        res = _RESPONSE_400
+        res['body'] = json.dumps('{k} should be one of {f}.'.format(k=_PARAM_KEY_FORMAT, f=','.join(_FORMATS)))
+        return res
+
+    interval = query_string_parameters.get(_PARAM_KEY_INTERVAL, '1m')
+    if interval not in exchange_adapters.INTERVAL_SECONDS:
+        res = _RESPONSE_400
+        res['body'] = json.dumps('{k} should be one of {i}.'.format(k=_PARAM_KEY_INTERVAL, i=','.join(exchange_adapters.INTERVAL_SECONDS.keys())))
+        return res
+    interval_seconds = exchange_adapters.INTERVAL_SECONDS[interval]
+
     from_t = datetime.datetime.strptime(query_string_parameters[_PARAM_KEY_FROM], _DATETIME_FORMAT)
     from_epoch_seconds = int(from_t.timestamp())
+    # the first candle covers from as a whole, like the exchanges align their candles.
+    from_epoch_seconds -= from_epoch_seconds % interval_seconds
     print("from_epoch_seconds", from_epoch_seconds, "from_t:", from_t)
 
-    items = []
-    if market == 'stock' or market == 'polygon':
-        items = _get_equity_minutely_ohlcv(symbol, from_epoch_seconds)
-    elif market == 'binance':
-        items = _get_binance_minutely_ohlcv(symbol, from_epoch_seconds)
-    elif market == 'okcoin':
-        items = _get_okcoin_minutely_ohlcv(symbol, from_epoch_seconds)
-    elif market == 'kraken':
-        items = _get_kraken_minutely_ohlcv(symbol, from_epoch_seconds)
-
-    result = items
-    return {
+    adapter = exchange_adapters.get_adapter(market)
+    complete_from = from_epoch_seconds
+    if symbols:
+        series, errors, truncated = {}, {}, {}
+        if adapter is None:
+            errors = {s: 'the market {m} is not supported.'.format(m=market) for s in symbols}
+        else:
+            series, errors, truncated = exchange_adapters.run(_get_batch_ohlcv(adapter, market, symbols, from_epoch_seconds, interval_seconds))
+            if not series:
+                res = _RESPONSE_503
+                res['body'] = json.dumps({'series': {}, 'errors': errors, 'truncated': {}})
+                return res
+        result = {
+            'series': {s: _format_series(columns, response_format) for s, columns in series.items()},
+            'errors': errors,
+            'truncated': truncated,
+        }
+    else:
+        columns = exchange_adapters.empty_columns()
+        if adapter is not None:
+            try:
+                columns, complete_from = exchange_adapters.run(_get_ohlcv(adapter, market, symbol, from_epoch_seconds, interval_seconds))
+            except exchange_adapters.UpstreamError as ex:
+                print('could not get the candles of {m} {s}:'.format(m=market, s=symbol), ex)
+                res = _RESPONSE_503
+                res['body'] = json.dumps('the candles of {s} could not be fetched from {m}.'.format(s=symbol, m=market))
+                return res
+        result = _format_series(columns, response_format)
+    print('rate limits:', rate_limit.stats())
+
+    body, content_type, is_base64_encoded = _get_body(event, result)
+    response = {
         'statusCode': 200,
         'headers': {
             'Access-Control-Allow-Headers': 'Content-Type',
             'Access-Control-Allow-Origin': '*',
-            'Access-Control-Allow-Methods': 'OPTIONS,POST,GET'
+            'Access-Control-Allow-Methods': 'OPTIONS,POST,GET',
+            'Access-Control-Expose-Headers': ','.join([_HEADER_KEY_TRUNCATED_FROM, _HEADER_KEY_ETAG]),
+            'Content-Type': content_type,
+            'Vary': _HEADER_KEY_ACCEPT
         },
-        'body': json.dumps(result, cls=DecimalEncoder)
+        'body': body
     }
+    if is_base64_encoded:
+        response['isBase64Encoded'] = True
+    if complete_from > from_epoch_seconds:
+        # the candles start later than asked, the range was longer than the exchange is asked for at once.
+        response['headers'][_HEADER_KEY_TRUNCATED_FROM] = str(complete_from)
+    return _with_encoding(event, _with_etag(event, response))
 
 
 
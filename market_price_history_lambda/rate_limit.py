@@ -0,0 +1,169 @@
+'''
+Token buckets pacing the outbound requests, one per host.
+
+A request takes `cost` tokens (its weight for binance) from the bucket of its host before it is
+sent. The tokens refill at the rate of the host up to its burst. A request finding the bucket
+empty is queued, sleeping until its tokens are there, rather than failed. The queue is first
+come first served as each request reserves its tokens right away.
+
+The budgets are adapted from the responses:
+
+- binance reports the weight used by the IP in the current minute in X-MBX-USED-WEIGHT-1M, which
+  counts the requests of every container, the bucket is capped to what is left of the minute,
+- a 429 or 418 pauses the bucket for its Retry-After.
+
+OUTBOUND_RATE_LIMITS='api.binance.com=80/200,api.kraken.com=1/1' overrides the rate/burst of the
+hosts. `stats()` returns the waits per host. The same file is shipped with every lambda that
+calls the exchanges, stripe or twilio.
+'''
+import asyncio, collections, os, threading, time, urllib.parse
+
+_BINANCE_WEIGHT_LIMIT_1M = int(os.getenv('BINANCE_WEIGHT_LIMIT_1M', '6000'))
+# of the weight limit, the rest is left to the other containers and the retries.
+_BINANCE_WEIGHT_SHARE = float(os.getenv('BINANCE_WEIGHT_SHARE', '0.8'))
+_BINANCE_WEIGHT_BUDGET_1M = _BINANCE_WEIGHT_LIMIT_1M * _BINANCE_WEIGHT_SHARE
+
+# tokens per second and burst, in weight for binance and in requests for the others.
+_HOST_RATE_LIMITS = {
+    'api.binance.com': (_BINANCE_WEIGHT_BUDGET_1M / 60, 200),
+    'api.polygon.io': (10, 10),
+    'www.okcoin.com': (8, 8),
+    'api.kraken.com': (1, 1),
+    'api.stripe.com': (25, 25),
+    'api.twilio.com': (10, 10),
+}
+_HOST_RATE_LIMITS.update({
+    host: tuple(float(v) for v in limit.split('/')) for host, _, limit in
+    (entry.partition('=') for entry in os.getenv('OUTBOUND_RATE_LIMITS', '').split(',') if entry)
+})
+_DEFAULT_RATE_LIMIT = (10, 10)
+_HOST_USED_WEIGHT_HEADERS = {
+    'api.binance.com': ('X-MBX-USED-WEIGHT-1M', _BINANCE_WEIGHT_BUDGET_1M),
+}
+_THROTTLED_STATUSES = {418, 429}
+_DEFAULT_RETRY_AFTER_SECONDS = 60
+_WAIT_SAMPLES = 200
+_WAIT_PERCENTILE = 0.95
+
+_buckets = {}
+_buckets_lock = threading.Lock()
+
+
+class TokenBucket:
+    '''
+    Token bucket of a host, shared by the threads and the coroutines of the container.
+    '''
+    def __init__(self, host):
+        self.host = host
+        self.rate, self.burst = _HOST_RATE_LIMITS.get(host, _DEFAULT_RATE_LIMIT)
+        self._tokens = self.burst
+        self._updated_at = time.monotonic()
+        self._paused_until = 0
+        self._lock = threading.Lock()
+        self._waits = collections.deque(maxlen=_WAIT_SAMPLES)
+        self.requests = 0
+        self.queued = 0
+        self.wait_seconds = 0
+        self.max_wait_seconds = 0
+        self.pauses = 0
+        self.used_weight = None
+
+    def _refill_locked(self, now):
+        self._tokens = min(self.burst, self._tokens + (now - self._updated_at) * self.rate)
+        self._updated_at = now
+
+    def reserve(self, cost=1):
+        '''
+        Takes `cost` tokens and returns how long to wait before sending the request.
+        '''
+        with self._lock:
+            now = time.monotonic()
+            self._refill_locked(now)
+            self._tokens -= cost
+            wait_seconds = max(0, -self._tokens / self.rate, self._paused_until - now)
+            self.requests += 1
+            self._waits.append(wait_seconds)
+            if wait_seconds > 0:
+                self.queued += 1
+                self.wait_seconds += wait_seconds
+                self.max_wait_seconds = max(self.max_wait_seconds, wait_seconds)
+        return wait_seconds
+
+    def acquire(self, cost=1):
+        '''
+        Blocks until `cost` tokens are there, returns the seconds waited.
+        '''
+        wait_seconds = self.reserve(cost)
+        if wait_seconds > 0:
+            time.sleep(wait_seconds)
+        return wait_seconds
+
+    async def acquire_async(self, cost=1):
+        wait_seconds = self.reserve(cost)
+        if wait_seconds > 0:
+            await asyncio.sleep(wait_seconds)
+        return wait_seconds
+
+    def pause(self, seconds):
+        with self._lock:
+            self.pauses += 1
+            self._paused_until = max(self._paused_until, time.monotonic() + seconds)
+
+    def on_response(self, status, headers):
+        '''
+        Adapts the bucket to the throttling and the used weight reported by the response.
+        '''
+        if status in _THROTTLED_STATUSES:
+            try:
+                retry_after_seconds = float(headers.get('Retry-After') or _DEFAULT_RETRY_AFTER_SECONDS)
+            except ValueError:
+                retry_after_seconds = _DEFAULT_RETRY_AFTER_SECONDS
+            print('{h} throttled the requests ({s}), pausing them for {r}s.'.format(h=self.host, s=status, r=retry_after_seconds))
+            self.pause(retry_after_seconds)
+            return
+
+        if self.host not in _HOST_USED_WEIGHT_HEADERS:
+            return
+        header, budget = _HOST_USED_WEIGHT_HEADERS[self.host]
+        used_weight = headers.get(header)
+        if used_weight is None:
+            return
+        self.used_weight = int(used_weight)
+        remaining = budget - self.used_weight
+        if remaining > 0:
+            with self._lock:
+                self._refill_locked(time.monotonic())
+                self._tokens = min(self._tokens, remaining)
+            return
+        # the used weight is reset at the start of every minute.
+        print('{h} used weight {w} is over the budget {b}, pausing the requests until the next minute.'.format(
+            h=self.host, w=self.used_weight, b=budget))
+        self.pause(60 - time.time() % 60)
+
+    def stats(self):
+        with self._lock:
+            waits = sorted(self._waits)
+            return {
+                'host': self.host,
+                'requests': self.requests,
+                'queued': self.queued,
+                'wait_seconds': round(self.wait_seconds, 3),
+                'max_wait_seconds': round(self.max_wait_seconds, 3),
+                'p95_wait_seconds': round(waits[int(len(waits) * _WAIT_PERCENTILE) - 1], 3) if waits else None,
+                'pauses': self.pauses,
+                'used_weight': self.used_weight,
+            }
+
+
+def get_bucket(url):
+    host = urllib.parse.urlsplit(url).hostname
+    with _buckets_lock:
+        if host not in _buckets:
+            _buckets[host] = TokenBucket(host)
+        return _buckets[host]
+
+
+def stats():
+    with _buckets_lock:
+        buckets = list(_buckets.values())
+    return [bucket.stats() for bucket in buckets]
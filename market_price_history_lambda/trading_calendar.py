@@ -0,0 +1,129 @@
+'''
+Calendar of the regular sessions of the US equity market (NYSE/Nasdaq).
+
+A session opens at 9:30 ET and closes at 16:00 ET, or at 13:00 ET on the half days (the day
+before Independence Day, the day after Thanksgiving and Christmas Eve). The open and close are
+epoch seconds worked out once per date, so the daylight saving time changes are accounted for.
+
+The holidays follow the exchange rules: a holiday on a Saturday is observed the Friday before
+(except New Year's Day, which is then not observed), one on a Sunday the Monday after.
+'''
+import bisect, datetime, functools
+import pytz
+
+_TIMEZONE_US_EAST = pytz.timezone('US/EASTERN')
+_OPEN_TIME = datetime.time(9, 30)
+_CLOSE_TIME = datetime.time(16, 0)
+_EARLY_CLOSE_TIME = datetime.time(13, 0)
+_JUNETEENTH_FIRST_YEAR = 2022
+
+# closures that do not follow a rule, the national days of mourning and hurricane Sandy.
+_SPECIAL_CLOSURES = {
+    datetime.date(2012, 10, 29), datetime.date(2012, 10, 30),
+    datetime.date(2018, 12, 5),
+    datetime.date(2025, 1, 9),
+}
+
+
+def _nth_weekday(year, month, weekday, n):
+    '''
+    Returns the `n`th `weekday` (0 is Monday) of the month, the last one if `n` is -1.
+    '''
+    if n > 0:
+        first = datetime.date(year, month, 1)
+        return first + datetime.timedelta(days=(weekday - first.weekday()) % 7 + 7 * (n - 1))
+    next_month = datetime.date(year + month // 12, month % 12 + 1, 1)
+    last = next_month - datetime.timedelta(days=1)
+    return last - datetime.timedelta(days=(last.weekday() - weekday) % 7)
+
+
+def _easter(year):
+    # the anonymous gregorian algorithm.
+    a = year % 19
+    b, c = divmod(year, 100)
+    d, e = divmod(b, 4)
+    f = (b + 8) // 25
+    g = (b - f + 1) // 3
+    h = (19 * a + b - d - g + 15) % 30
+    i, k = divmod(c, 4)
+    l = (32 + 2 * e + 2 * i - h - k) % 7
+    m = (a + 11 * h + 22 * l) // 451
+    month, day = divmod(h + l - 7 * m + 114, 31)
+    return datetime.date(year, month, day + 1)
+
+
+def _observed(day):
+    if day.weekday() == 5:
+        return day - datetime.timedelta(days=1)
+    if day.weekday() == 6:
+        return day + datetime.timedelta(days=1)
+    return day
+
+
+@functools.lru_cache(maxsize=None)
+def _get_holidays(year):
+    holidays = {
+        _nth_weekday(year, 1, 0, 3),  # Martin Luther King Jr. Day
+        _nth_weekday(year, 2, 0, 3),  # Washington's Birthday
+        _easter(year) - datetime.timedelta(days=2),  # Good Friday
+        _nth_weekday(year, 5, 0, -1),  # Memorial Day
+        _observed(datetime.date(year, 7, 4)),
+        _nth_weekday(year, 9, 0, 1),  # Labor Day
+        _nth_weekday(year, 11, 3, 4),  # Thanksgiving Day
+        _observed(datetime.date(year, 12, 25)),
+    }
+    new_year = datetime.date(year, 1, 1)
+    if new_year.weekday() != 5:
+        holidays.add(_observed(new_year))
+    if year >= _JUNETEENTH_FIRST_YEAR:
+        holidays.add(_observed(datetime.date(year, 6, 19)))
+    return frozenset(holidays)
+
+
+@functools.lru_cache(maxsize=None)
+def _get_early_closes(year):
+    early_closes = {_nth_weekday(year, 11, 3, 4) + datetime.timedelta(days=1)}
+    for day in [datetime.date(year, 7, 3), datetime.date(year, 12, 24)]:
+        # on a friday these are the observed holiday instead.
+        if day.weekday() < 4:
+            early_closes.add(day)
+    return frozenset(early_closes)
+
+
+def is_trading_day(day):
+    return day.weekday() < 5 and day not in _get_holidays(day.year) and day not in _SPECIAL_CLOSURES
+
+
+@functools.lru_cache(maxsize=4096)
+def get_session(day):
+    '''
+    Returns the (open, close) epoch seconds of the regular session of the date, None if the market is closed.
+    '''
+    if not is_trading_day(day):
+        return None
+    close_time = _EARLY_CLOSE_TIME if day in _get_early_closes(day.year) else _CLOSE_TIME
+    open_dt = _TIMEZONE_US_EAST.localize(datetime.datetime.combine(day, _OPEN_TIME))
+    close_dt = _TIMEZONE_US_EAST.localize(datetime.datetime.combine(day, close_time))
+    return int(open_dt.timestamp()), int(close_dt.timestamp())
+
+
+def get_sessions(from_epoch_seconds, to_epoch_seconds):
+    '''
+    Returns the (date, open, close) of the sessions overlapping [from_epoch_seconds, to_epoch_seconds).
+    '''
+    day = datetime.datetime.fromtimestamp(from_epoch_seconds, tz=pytz.utc).astimezone(_TIMEZONE_US_EAST).date()
+    last_day = datetime.datetime.fromtimestamp(to_epoch_seconds, tz=pytz.utc).astimezone(_TIMEZONE_US_EAST).date()
+    ret = []
+    while day <= last_day:
+        session = get_session(day)
+        if session is not None and session[1] > from_epoch_seconds and session[0] < to_epoch_seconds:
+            ret.append((day, session[0], session[1]))
+        day += datetime.timedelta(days=1)
+    return ret
+
+
+def get_session_range(ts, open_epoch_seconds, close_epoch_seconds):
+    '''
+    Returns the [begin, end) indexes of the sorted epoch seconds `ts` within the session.
+    '''
+    return bisect.bisect_left(ts, open_epoch_seconds), bisect.bisect_left(ts, close_epoch_seconds)
@@ -1,6 +1,6 @@
-import json, os
+import base64, collections, hashlib, json, os, threading, time
 import requests
-from authlib.jose import JsonWebToken
+from authlib.jose import JsonWebToken, RSAKey
 
 _EVENT_KEY_PATH_PARAMETER = 'pathParameters'
 _PATH_PARAMETER_USER = 'user'
@@ -12,6 +12,179 @@ _AUDIENCE_URL_PATH = 'api/v2/'
 _JWT = JsonWebToken(['RS256'])
 _KEY_PREFIX = '-----BEGIN CERTIFICATE-----\n'
 _KEY_POSTFIX = '\n-----END CERTIFICATE-----'
+_JWKS_TTL_SECONDS = int(os.getenv('AUTH0_JWKS_TTL_SECONDS', '3600'))
+_JWKS_MIN_REFRESH_INTERVAL_SECONDS = 30
+_JWKS_REQUEST_TIMEOUT_SECONDS = 5
+_TOKEN_CACHE_MAX_ENTRIES = int(os.getenv('AUTH0_TOKEN_CACHE_MAX_ENTRIES', '1024'))
+
+_jwks_store = None
+_verified_token_cache = None
+
+
+def _import_key(x5c_cert):
+    return RSAKey.import_key((_KEY_PREFIX + x5c_cert + _KEY_POSTFIX).encode('ascii'))
+
+
+class JwksStore:
+    '''
+    Keeps the Auth0 signing keys indexed by kid for the lifetime of a warm container.
+    The certificates are parsed into key objects once per fetch, not once per token.
+
+    The keys are refreshed in the background once they are older than the ttl, and
+    synchronously when a token presents a kid that is not known yet (key rotation).
+    '''
+    def __init__(self, url, ttl_seconds=_JWKS_TTL_SECONDS, min_refresh_interval_seconds=_JWKS_MIN_REFRESH_INTERVAL_SECONDS):
+        self.url = url
+        self.ttl_seconds = ttl_seconds
+        self.min_refresh_interval_seconds = min_refresh_interval_seconds
+        self._keys = {}
+        self._fetched_at = 0
+        self._unknown_kid_refreshed_at = 0
+        self._lock = threading.Lock()
+        self._refreshing = False
+
+    def _fetch(self):
+        r = requests.get(self.url, timeout=_JWKS_REQUEST_TIMEOUT_SECONDS)
+        if not r.ok:
+            print('could not fetch the jwks:', r.reason)
+            return None
+
+        keys = {}
+        for k in r.json()['keys']:
+            if not k.get('x5c'):
+                continue
+            try:
+                # the first certificate of the chain holds the signing key.
+                keys[k.get('kid')] = _import_key(k['x5c'][0])
+            except Exception as ex:
+                print('could not import the key {kid}:'.format(kid=k.get('kid')), ex)
+        return keys
+
+    def refresh(self):
+        try:
+            keys = self._fetch()
+        except Exception as ex:
+            print('could not fetch the jwks as an exception happened:', ex)
+            keys = None
+        with self._lock:
+            if keys is not None:
+                self._keys = keys
+                self._fetched_at = time.time()
+            self._refreshing = False
+
+    def _refresh_in_background(self):
+        with self._lock:
+            if self._refreshing:
+                return
+            self._refreshing = True
+        threading.Thread(target=self.refresh, daemon=True).start()
+
+    def _can_refresh_for_unknown_kid(self):
+        # bounds the jwks requests a token with a forged kid can trigger.
+        now = time.time()
+        with self._lock:
+            if now - self._unknown_kid_refreshed_at < self.min_refresh_interval_seconds:
+                return False
+            self._unknown_kid_refreshed_at = now
+        return True
+
+    def get_key(self, kid):
+        if not self._keys:
+            self.refresh()
+        elif time.time() - self._fetched_at >= self.ttl_seconds:
+            self._refresh_in_background()
+
+        key = self._keys.get(kid)
+        if key is None and self._can_refresh_for_unknown_kid():
+            print('kid {kid} is unknown, refreshing the jwks.'.format(kid=kid))
+            self.refresh()
+            key = self._keys.get(kid)
+        return key
+
+    def get_keys(self):
+        if not self._keys:
+            self.refresh()
+        return list(self._keys.values())
+
+
+def get_jwks_store():
+    global _jwks_store
+    if _jwks_store is None:
+        _jwks_store = JwksStore(_APPLICATION_BASE_URL + _JWKS_URL_PATH)
+    return _jwks_store
+
+
+class VerifiedTokenCache:
+    '''
+    Bounded LRU of tokens that passed validation, keyed by the sha256 digest of the token.
+
+    An entry keeps the claims the token was validated against (sub, aud, iss) and expires at
+    the token's exp, so a repeated token skips the signature check until it expires.
+    Entries are a digest plus a few short claims, so max_entries bounds the memory used.
+    '''
+    def __init__(self, max_entries=_TOKEN_CACHE_MAX_ENTRIES):
+        self.max_entries = max_entries
+        self._entries = collections.OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.expirations = 0
+
+    @staticmethod
+    def _digest(encoded):
+        return hashlib.sha256(encoded.encode('utf-8')).digest()
+
+    def get(self, encoded):
+        digest = self._digest(encoded)
+        with self._lock:
+            entry = self._entries.get(digest)
+            if entry is None:
+                self.misses += 1
+                return None
+            if entry['exp'] <= time.time():
+                del self._entries[digest]
+                self.expirations += 1
+                self.misses += 1
+                return None
+            self._entries.move_to_end(digest)
+            self.hits += 1
+            return entry
+
+    def put(self, encoded, claims):
+        if self.max_entries <= 0 or 'exp' not in claims:
+            return
+        entry = {
+            'sub': claims.get('sub'),
+            'aud': claims.get('aud'),
+            'iss': claims.get('iss'),
+            'exp': int(claims['exp']),
+        }
+        digest = self._digest(encoded)
+        with self._lock:
+            self._entries[digest] = entry
+            self._entries.move_to_end(digest)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+                self.evictions += 1
+
+    def stats(self):
+        with self._lock:
+            return {
+                'size': len(self._entries),
+                'max_entries': self.max_entries,
+                'hits': self.hits,
+                'misses': self.misses,
+                'evictions': self.evictions,
+                'expirations': self.expirations,
+            }
+
+
+def get_verified_token_cache():
+    global _verified_token_cache
+    if _verified_token_cache is None:
+        _verified_token_cache = VerifiedTokenCache()
+    return _verified_token_cache
 
 def _get_token_from_event(event):
     if _EVENT_KEY_HEADERS in event:
@@ -19,14 +192,22 @@ def _get_token_from_event(event):
         if headers and _HEADER_KEY_AUTHORIZATION in headers:
             return headers[_HEADER_KEY_AUTHORIZATION].split('Bearer ')[-1]
 
+def _get_token_kid(encoded):
+    try:
+        header_segment = encoded.split('.')[0]
+        header_segment += '=' * (-len(header_segment) % 4)
+        return json.loads(base64.urlsafe_b64decode(header_segment)).get('kid')
+    except Exception as ex:
+        print('could not read the kid from the token header:', ex)
+        return None
+
 def _validate(event, key):
     encoded = _get_token_from_event(event)
     if encoded is None:
         print('not authed as the auth token is None')
         return False
-    key_binary = key.encode('ascii')
     try:
-        claims = _JWT.decode(encoded, key_binary)
+        claims = _JWT.decode(encoded, key)
         claims_option = {
             "iss": {
                 "essential": True,
@@ -44,18 +225,46 @@ def _validate(event, key):
         print(ex)
         return False
 
+    get_verified_token_cache().put(encoded, claims)
     return True
 
-def _get_keys():
-    url = _APPLICATION_BASE_URL + _JWKS_URL_PATH
-    r = requests.get(url)
-    if not r.ok:
+def _is_authorized_from_cache(event):
+    '''
+    Returns True if the token of the event was already validated and has not expired yet.
+    '''
+    encoded = _get_token_from_event(event)
+    if encoded is None:
+        return False
+    cached_claims = get_verified_token_cache().get(encoded)
+    if cached_claims is None:
+        return False
+    if cached_claims['iss'] != _APPLICATION_BASE_URL:
+        return False
+    return True
+
+def _get_keys(event):
+    '''
+    Returns the keys to validate the token of the event with.
+
+    A single key matching the kid in the token header is returned when the header has one.
+    '''
+    encoded = _get_token_from_event(event)
+    if encoded is None:
+        print('not authed as the auth token is None')
         return []
 
-    return [_KEY_PREFIX + k + _KEY_POSTFIX for ks in list(map(lambda k: k['x5c'], r.json()['keys'])) for k in ks]
+    store = get_jwks_store()
+    kid = _get_token_kid(encoded)
+    if kid is None:
+        return store.get_keys()
+
+    key = store.get_key(kid)
+    return [key] if key is not None else []
 
 def is_authorized(event):
-    ks = _get_keys()
+    if _is_authorized_from_cache(event):
+        return True
+    ks = _get_keys(event)
     for k in ks:
         if _validate(event, k):
             return True